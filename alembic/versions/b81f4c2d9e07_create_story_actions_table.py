@@ -0,0 +1,35 @@
+"""create story actions table
+
+Revision ID: b81f4c2d9e07
+Revises: 6336b3efaac0
+Create Date: 2026-10-18 09:12:04.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f4c2d9e07'
+down_revision = '6336b3efaac0'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'story_actions',
+        sa.Column('story_uuid', sa.String, sa.ForeignKey('stories.uuid', ondelete='CASCADE'), primary_key=True),
+        # index of the action in the story's entries, actions follow the snapshot in stories.content
+        sa.Column('position', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('text', sa.String, unique=False),
+        sa.Column('texttype', sa.Integer, unique=False),
+        sa.Column('token_count', sa.Integer, unique=False, nullable=True)
+    )
+    # the activation state changes every turn, keep it out of the snapshot
+    op.add_column('stories', sa.Column('activation', sa.String, unique=False, nullable=True))
+    pass
+
+def downgrade():
+    op.drop_column('stories', 'activation')
+    op.drop_table('story_actions')
+    pass
@@ -0,0 +1,25 @@
+"""add story updated_at
+
+Revision ID: d4a7e1c3f5b8
+Revises: b81f4c2d9e07
+Create Date: 2026-10-18 14:03:27.541906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7e1c3f5b8'
+down_revision = 'b81f4c2d9e07'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # existing stories get the time of the migration
+    op.add_column('stories', sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False))
+    pass
+
+def downgrade():
+    op.drop_column('stories', 'updated_at')
+    pass
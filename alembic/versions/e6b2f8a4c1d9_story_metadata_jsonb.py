@@ -0,0 +1,43 @@
+"""story metadata jsonb
+
+Revision ID: e6b2f8a4c1d9
+Revises: d4a7e1c3f5b8
+Create Date: 2026-10-18 15:21:44.902117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b2f8a4c1d9'
+down_revision = 'd4a7e1c3f5b8'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # backfill rows without metadata so every row converts, the defaults of
+    # StoryMetadataV1 fill in the fields when the story is loaded
+    op.execute("UPDATE stories SET content_metadata = '{}' WHERE content_metadata IS NULL OR content_metadata = ''")
+    # the metadata was stored as JSON text, cast it so single fields can be updated in place
+    op.alter_column(
+        'stories', 'content_metadata',
+        type_=postgresql.JSONB,
+        existing_type=sa.String,
+        postgresql_using='content_metadata::jsonb',
+        server_default=sa.text("'{}'::jsonb"),
+        nullable=False
+    )
+    pass
+
+def downgrade():
+    op.alter_column(
+        'stories', 'content_metadata',
+        type_=sa.String,
+        existing_type=postgresql.JSONB,
+        postgresql_using='content_metadata::text',
+        server_default=None,
+        nullable=True
+    )
+    pass
@@ -0,0 +1,52 @@
+"""compress story content
+
+Revision ID: f1c9d3b7a2e5
+Revises: e6b2f8a4c1d9
+Create Date: 2026-10-18 16:40:12.377215
+
+"""
+import zlib
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c9d3b7a2e5'
+down_revision = 'e6b2f8a4c1d9'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # existing rows keep their JSON text as bytes, the codec reads them by their leading '{'
+    # and compresses them the next time the story is snapshotted
+    op.alter_column(
+        'stories', 'content',
+        type_=sa.LargeBinary,
+        existing_type=sa.String,
+        postgresql_using="convert_to(content, 'UTF8')"
+    )
+
+def downgrade():
+    # compressed rows have to be decoded here, postgres cannot inflate them
+    conn = op.get_bind()
+    stories = sa.table('stories', sa.column('uuid', sa.String), sa.column('content', sa.LargeBinary))
+    for uuid, content in conn.execute(sa.select(stories.c.uuid, stories.c.content)).fetchall():
+        if content is None:
+            continue
+        content = bytes(content)
+        if (len(content) == 0) or (content[:1] == b'{'):
+            continue
+        if content[0] == 1:
+            content = zlib.decompress(content[1:])
+        elif content[0] == 2:
+            import zstandard
+            content = zstandard.ZstdDecompressor().decompress(content[1:])
+        else:
+            content = content[1:]
+        conn.execute(stories.update().where(stories.c.uuid == uuid).values(content=content))
+    op.alter_column(
+        'stories', 'content',
+        type_=sa.String,
+        existing_type=sa.LargeBinary,
+        postgresql_using="convert_from(content, 'UTF8')"
+    )
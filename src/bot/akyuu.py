@@ -1,19 +1,66 @@
+import asyncio
+import time
 import discord
 from discord.ext import commands
+from src.core.config import settings
 from src.core.logging import get_logger
+from src.stories.cache import object_cache
+from src.stories.codec import content_codec
 from src.stories.core import load_cache
+from src.stories.story import context_cache
+from src.stories.tokenizer import tokenizer_service
+from src.stories.workers import worker_pool
 
 class Akyuu(commands.Bot):
     def __init__(self, args):
+        self.started = time.perf_counter()
         super().__init__(command_prefix=args.prefix, intents=discord.Intents.all())
         self.args = args
         self.logger = get_logger(__name__)
+        self.stats_task = None
         load_cache()
         self.load_extension('src.bot.storycog')
 
     async def on_ready(self):
-        self.logger.info(f'Logged in as {self.user.name} ({self.user.id})')
+        self.logger.info(f'Logged in as {self.user.name} ({self.user.id}) {time.perf_counter() - self.started:.2f}s after startup')
+        # the tokenizer is not needed to connect, so it is loaded once the bot is up
+        tokenizer_service.warm()
+        # saved users and stories are written behind on a timer
+        object_cache.start()
+        # and the cache statistics logged on a timer
+        if (settings.STATS_LOG_INTERVAL > 0) and (self.stats_task is None):
+            self.stats_task = self.loop.create_task(self.log_stats())
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='over the records.📚'))
     
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(settings.STATS_LOG_INTERVAL)
+            self.logger.info(f'context cache: {context_cache.hit_rate():.1%} hits, {len(context_cache.entries)} prompts')
+            stats = object_cache.stats()
+            self.logger.info(
+                f'object cache: {stats["hit_rate"]:.1%} hits, {stats["objects"]} objects in {stats["bytes"]} bytes, '
+                f'{stats["dirty"]} dirty, {stats["writes"]} writes for {stats["saves"]} saves'
+            )
+            stats = content_codec.stats()
+            self.logger.info(
+                f'content codec: {stats["codec"]}, {stats["raw_bytes"]} bytes encoded {stats["ratio"]:.2f}x smaller in {stats["encode_time"]:.3f}s, '
+                f'{stats["decoded"]} decoded in {stats["decode_time"]:.3f}s'
+            )
+            stats = worker_pool.stats()
+            self.logger.info(
+                f'worker pool: {stats["jobs"]} jobs, {stats["avg_wait"]:.3f}s wait and {stats["avg_run"]:.3f}s run on average, '
+                f'{stats["in_flight"]} running or queued'
+            )
+
     async def close(self):
-        await self.close()
\ No newline at end of file
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+            self.stats_task = None
+        # write what the object cache still holds before the loop goes away
+        try:
+            await object_cache.close()
+        except Exception as e:
+            self.logger.error(f'could not flush the object cache: {e}')
+        # the flush encodes story content in the workers, they are stopped after it
+        worker_pool.shutdown()
+        await super().close()
\ No newline at end of file
@@ -1,5 +1,5 @@
 import asyncio
-from io import StringIO
+import tempfile
 from typing import Optional
 import discord
 from discord.commands import SlashCommandGroup, Option
@@ -191,15 +191,20 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
         return embed
     
     async def print_memory(self, id, embed):
-        story = await get_current_story(id)
-        embed.title = f'{story.content_metadata.title}'
-        embed.description = f'**``Memory``**:\n{story.content_metadata.memory}'
-        return embed
+        return self.memory_embed(await get_current_story_metadata(id), embed)
     
     async def print_authorsnote(self, id, embed):
-        story = await get_current_story(id)
-        embed.title = f'{story.content_metadata.title}'
-        embed.description = f'**``Author\'s Note``**:\n{story.content_metadata.authorsNote}'
+        return self.authorsnote_embed(await get_current_story_metadata(id), embed)
+
+    # render from the metadata alone, so viewing or setting them does not load the story content
+    def memory_embed(self, content_metadata, embed):
+        embed.title = f'{content_metadata.title}'
+        embed.description = f'**``Memory``**:\n{content_metadata.memory}'
+        return embed
+
+    def authorsnote_embed(self, content_metadata, embed):
+        embed.title = f'{content_metadata.title}'
+        embed.description = f'**``Author\'s Note``**:\n{content_metadata.authorsNote}'
         return embed
     
     @stories.command(name='view', description='View your selected story.')
@@ -226,8 +231,10 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
     async def async_submit(self, ctx: discord.ApplicationContext, text, embed, generate):
         original_message = await ctx.interaction.original_message()
         try:
-            await cmd_story_submit(ctx.interaction.user.id, text, self.model_provider, generate)
-            embed = await self.print_story(ctx.interaction.user.id, 768, embed)
+            # the story is rendered from the objects the command loaded, in the same unit of work
+            async with unit_of_work():
+                await cmd_story_submit(ctx.interaction.user.id, text, self.model_provider, generate)
+                embed = await self.print_story(ctx.interaction.user.id, 768, embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully submitted the action.', icon_url=ctx.interaction.user.avatar.url)
             await original_message.edit(embed=embed)
         except Exception as e:
@@ -238,8 +245,9 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
     async def async_retry(self, ctx: discord.ApplicationContext, embed):
         original_message = await ctx.interaction.original_message()
         try:
-            await cmd_story_retry(ctx.interaction.user.id, self.model_provider)
-            embed = await self.print_story(ctx.interaction.user.id, 768, embed)
+            async with unit_of_work():
+                await cmd_story_retry(ctx.interaction.user.id, self.model_provider)
+                embed = await self.print_story(ctx.interaction.user.id, 768, embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully retried the action.', icon_url=ctx.interaction.user.avatar.url)
             original_message = await ctx.interaction.original_message()
             await original_message.edit(embed=embed)
@@ -280,9 +288,9 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
         message = await ctx.interaction.original_message()
         try:
             id = ctx.interaction.user.id
-            await cmd_story_undo(id)
-
-            embed = await self.print_story(id, 768, embed)
+            async with unit_of_work():
+                await cmd_story_undo(id)
+                embed = await self.print_story(id, 768, embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully undoed the last action.', icon_url=ctx.interaction.user.avatar.url)
             await message.edit(embed=embed)
         except Exception as e:
@@ -311,9 +319,9 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
             id = ctx.interaction.user.id
             if no_newline == False:
                 text = '\n' + text
-            await cmd_story_alter(id, text)
-
-            embed = await self.print_story(id, 768, embed)
+            async with unit_of_work():
+                await cmd_story_alter(id, text)
+                embed = await self.print_story(id, 768, embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully altered the last action.', icon_url=ctx.interaction.user.avatar.url)
             await message.edit(embed=embed)
         except Exception as e:
@@ -328,9 +336,7 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
         message = await ctx.interaction.original_message()
         try:
             id = ctx.interaction.user.id
-            await cmd_story_memory(id, text)
-
-            embed = await self.print_story(id, 768, embed)
+            embed = self.memory_embed(await cmd_story_memory(id, text), embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully set the memory of the story.', icon_url=ctx.interaction.user.avatar.url)
             await message.edit(embed=embed)
         except Exception as e:
@@ -345,15 +351,50 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
         message = await ctx.interaction.original_message()
         try:
             id = ctx.interaction.user.id
-            await cmd_story_authorsnote(id, text)
-
-            embed = await self.print_story(id, 768, embed)
+            embed = self.authorsnote_embed(await cmd_story_authorsnote(id, text), embed)
             embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully set the authors note of the story.', icon_url=ctx.interaction.user.avatar.url)
             await message.edit(embed=embed)
         except Exception as e:
             embed = discord.Embed(title='Setting authors note failed.', description=f'An error has occurred while setting the authors note of the story.\nError: {e}', color=embed_color)
             await message.edit(embed=embed)
 
+    @stories.command(name='stickyturns', description='Keep lorebook entries active for a number of turns after they stop matching.')
+    async def stickyturns(self, ctx: discord.ApplicationContext, turns: Option(int, 'The number of turns an entry stays active after its keys leave the story.', min_value=0)):
+        embed = discord.Embed(title='Setting sticky turns...', description='Please wait warmly while we set the sticky turns of the story.', color=embed_color)
+        embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator}', icon_url=ctx.interaction.user.avatar.url)
+        await ctx.respond(embed=embed)
+        message = await ctx.interaction.original_message()
+        try:
+            id = ctx.interaction.user.id
+            await cmd_story_stickyturns(id, turns)
+            embed.title = 'Done.'
+            embed.description = f'Lorebook entries now stay active for **``{turns}``** turns after they stop matching.'
+            embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully set the sticky turns of the story.', icon_url=ctx.interaction.user.avatar.url)
+            await message.edit(embed=embed)
+        except Exception as e:
+            embed = discord.Embed(title='Setting sticky turns failed.', description=f'An error has occurred while setting the sticky turns of the story.\nError: {e}', color=embed_color)
+            await message.edit(embed=embed)
+
+    @stories.command(name='retrieval', description='Choose lorebook entries by ranking them against the story instead of matching their keys.')
+    async def retrieval(self, ctx: discord.ApplicationContext, enabled: Option(bool, 'Set this to true to rank lorebook entries, false to match their keys.')):
+        embed = discord.Embed(title='Setting retrieval...', description='Please wait warmly while we set how lorebook entries are chosen.', color=embed_color)
+        embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator}', icon_url=ctx.interaction.user.avatar.url)
+        await ctx.respond(embed=embed)
+        message = await ctx.interaction.original_message()
+        try:
+            id = ctx.interaction.user.id
+            await cmd_story_retrieval(id, enabled)
+            embed.title = 'Done.'
+            if enabled:
+                embed.description = 'Lorebook entries are now ranked against the story.'
+            else:
+                embed.description = 'Lorebook entries are now activated by their keys.'
+            embed.set_footer(text=f'{ctx.interaction.user.name}#{ctx.interaction.user.discriminator} - Successfully set retrieval for the story.', icon_url=ctx.interaction.user.avatar.url)
+            await message.edit(embed=embed)
+        except Exception as e:
+            embed = discord.Embed(title='Setting retrieval failed.', description=f'An error has occurred while setting how lorebook entries are chosen.\nError: {e}', color=embed_color)
+            await message.edit(embed=embed)
+
     # supplemental commands
     @stories.command(name='download', description='Download the selected story.')
     async def download(self, ctx: discord.ApplicationContext):
@@ -362,11 +403,12 @@ class StoryCog(commands.Cog, name='Stories', description='Use our powerful AI to
         await ctx.respond(embed=embed)
         message = await ctx.interaction.original_message()
         try:
-            with StringIO() as f:
+            # the story is written out entry by entry instead of being joined in memory
+            with tempfile.TemporaryFile() as f:
                 id = ctx.interaction.user.id
                 story = await get_current_story(id)
-                text = story.raw_txt(False, False, None)
-                f.write(text)
+                for text in story.iter_txt():
+                    f.write(text.encode('utf-8'))
                 f.seek(0)
                 embed.title = 'Done.'
                 embed.description = f'See the attached file for your story.'
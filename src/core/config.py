@@ -1,5 +1,4 @@
 from pathlib import Path
-from os import PathLike
 from typing import Any, Dict, Optional
 
 from pydantic import BaseSettings, validator
@@ -28,7 +27,15 @@ class Settings(BaseSettings):
     SUKIMA_PASSWORD: Optional[str]
 
     DATABASE_URI: Optional[str] = None
-    STORAGE_PATH: PathLike = Path.cwd() / "storage"
+    STORAGE_PATH: Path = Path.cwd() / "storage"
+    TOKENIZER_NAME: str = "gpt2"
+    WORKER_POOL_TYPE: str = "thread"
+    WORKER_POOL_SIZE: int = 2
+    OBJECT_CACHE_SIZE: int = 64 * 1024 * 1024 # bytes, 0 disables the cache and write behind
+    OBJECT_CACHE_IDLE: float = 600.0
+    OBJECT_CACHE_FLUSH_INTERVAL: float = 5.0
+    CONTENT_CODEC: str = "auto" # zstd when the zstandard package is installed, zlib otherwise, or none
+    STATS_LOG_INTERVAL: float = 600.0 # seconds between logs of the cache, codec and worker statistics, 0 disables them
 
     @validator("DATABASE_URI", pre=True)
     def assemble_db_connection(cls, v: Optional[str], values: Dict[str, Any]) -> Any:
@@ -1 +1 @@
-from src.db.schemas.user import User, Story
\ No newline at end of file
+from src.db.schemas.user import User, Story, StoryAction
\ No newline at end of file
@@ -1,41 +1,34 @@
-from typing import Optional
+from typing import List, Optional
 
 from src.db.crud.base import CrudBase
-from src.db.models.user import User, Story
+from src.db.models.user import User, Story, StoryAction
 from src.db.schemas.user import UserUpdate, StoryUpdate
-from sqlalchemy import select
+from sqlalchemy import Text, cast, delete, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, array, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 class CrudUser(CrudBase[User, User, UserUpdate]):
     async def get_by_ids(self, session: AsyncSession, id: int) -> Optional[User]:
         return (await session.execute(select(self.model).where(self.model.id == id))).scalars().first()
     
-    async def create_user(self, session: AsyncSession, *, id: int, gensettings: str, storyids: str, quota: int) -> User:
-        db_obj = User(
+    # creates or updates the user in a single INSERT ... ON CONFLICT DO UPDATE
+    async def upsert_user(self, session: AsyncSession, *, id: int, gensettings: str, storyids: str, quota: int) -> None:
+        stmt = insert(self.model).values(
             id=id,
             gensettings=gensettings,
             storyids=storyids,
             quota=quota
         )
-
-        session.add(db_obj)
-        await session.commit()
-
-        return db_obj
-    
-    async def update_user(self, session: AsyncSession, *, id: int, gensettings: str, storyids: str, quota: int) -> Optional[User]:
-        db_obj = (await session.execute(select(self.model).where(self.model.id == id))).scalars().first()
-
-        if db_obj is None:
-            return None
-
-        db_obj.gensettings = gensettings
-        db_obj.storyids = storyids
-        db_obj.quota = quota
-
-        await session.commit()
-
-        return db_obj
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[self.model.id],
+            set_={
+                'gensettings': stmt.excluded.gensettings,
+                'storyids': stmt.excluded.storyids,
+                'quota': stmt.excluded.quota
+            }
+        ))
+
+        await session.flush()
     
     async def delete_user(self, session: AsyncSession, id: int) -> Optional[User]:
         db_obj = (await session.execute(select(self.model).where(self.model.id == id))).scalars().first()
@@ -44,7 +37,7 @@ class CrudUser(CrudBase[User, User, UserUpdate]):
             return None
 
         await session.delete(db_obj)
-        await session.commit()
+        await session.flush()
 
         return db_obj
 
@@ -52,32 +45,103 @@ class StoryCrud(CrudBase[Story, Story, StoryUpdate]):
     async def get_by_ids(self, session: AsyncSession, uuid: str) -> Optional[Story]:
         return (await session.execute(select(self.model).where(self.model.uuid == uuid))).scalars().first()
     
-    async def create_story(self, session: AsyncSession, *, uuid: str, owner_id: int, content_metadata: str, content: str) -> Story:
-        db_obj = Story(
+    # the metadata of a story without its content, None if the story does not exist
+    async def get_metadata(self, session: AsyncSession, uuid: str) -> Optional[dict]:
+        return (await session.execute(select(self.model.content_metadata).where(self.model.uuid == uuid))).scalar_one_or_none()
+
+    # every story of an owner without its content, in one query on the owner_id index.
+    # octet_length reads the stored size of the content without detoasting it
+    async def list_by_owner(self, session: AsyncSession, owner_id: int) -> list:
+        return (await session.execute(
+            select(
+                self.model.uuid,
+                self.model.content_metadata,
+                (func.octet_length(self.model.content) + func.coalesce(func.sum(func.octet_length(StoryAction.text)), 0)).label('content_bytes'),
+                func.count(StoryAction.position).label('actions'),
+                self.model.updated_at
+            )
+            .outerjoin(StoryAction, StoryAction.story_uuid == self.model.uuid)
+            .where(self.model.owner_id == owner_id)
+            .group_by(self.model.uuid)
+        )).all()
+
+    async def get_actions(self, session: AsyncSession, uuid: str) -> List[StoryAction]:
+        return (await session.execute(select(StoryAction).where(StoryAction.story_uuid == uuid).order_by(StoryAction.position))).scalars().all()
+
+    # creates the story or overwrites its snapshot in a single INSERT ... ON CONFLICT DO
+    # UPDATE. the snapshot holds every entry, so it also folds the stored actions into the
+    # content on compaction, and they are dropped
+    async def upsert_story(self, session: AsyncSession, *, uuid: str, owner_id: int, content_metadata: dict, content: bytes, activation: str) -> None:
+        stmt = insert(self.model).values(
             uuid=uuid,
             owner_id=owner_id,
             content_metadata=content_metadata,
-            content=content
+            content=content,
+            activation=activation
+        )
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[self.model.uuid],
+            set_={
+                'content_metadata': stmt.excluded.content_metadata,
+                'content': stmt.excluded.content,
+                'activation': stmt.excluded.activation,
+                'updated_at': func.now()
+            }
+        ))
+        await session.execute(delete(StoryAction).where(StoryAction.story_uuid == uuid))
+
+        await session.flush()
+
+    # sets only the given top level fields of the metadata, server side with jsonb_set, so
+    # neither the rest of the metadata nor the content is read or written. returns the
+    # updated metadata, None if the story does not exist
+    async def update_metadata(self, session: AsyncSession, *, uuid: str, fields: dict) -> Optional[dict]:
+        # the values are bound as JSONB, which serializes them itself
+        content_metadata = func.coalesce(self.model.content_metadata, cast({}, JSONB))
+        for key, value in fields.items():
+            content_metadata = func.jsonb_set(content_metadata, cast(array([key]), ARRAY(Text)), cast(value, JSONB))
+        result = await session.execute(
+            update(self.model)
+            .where(self.model.uuid == uuid)
+            .values(content_metadata=content_metadata)
+            .returning(self.model.content_metadata)
         )
 
-        session.add(db_obj)
-        await session.commit()
-
-        return db_obj
-    
-    async def update_story(self, session: AsyncSession, *, uuid: str, content_metadata: str, content: str) -> Optional[Story]:
-        db_obj = (await session.execute(select(self.model).where(self.model.uuid == uuid))).scalars().first()
-
-        if db_obj is None:
-            return None
-
-        db_obj.content_metadata = content_metadata
-        db_obj.content = content
-
-        await session.commit()
+        await session.flush()
+
+        return result.scalar_one_or_none()
+
+    # writes actions, a list of (text, texttype, token_count), to the positions from start on
+    # and drops the stored actions from position length on when truncate is set. the story
+    # row is updated without being selected first, its metadata only when it is given
+    async def append_actions(self, session: AsyncSession, *, uuid: str, content_metadata: Optional[dict], activation: str, start: int, actions: list, length: int, truncate: bool) -> None:
+        values = {'activation': activation}
+        if content_metadata is not None:
+            values['content_metadata'] = content_metadata
+        await session.execute(
+            update(self.model)
+            .where(self.model.uuid == uuid)
+            .values(**values)
+        )
+        if truncate:
+            await session.execute(delete(StoryAction).where(StoryAction.story_uuid == uuid, StoryAction.position >= length))
+        if len(actions) > 0:
+            stmt = insert(StoryAction).values([
+                {'story_uuid': uuid, 'position': start + idx, 'text': text, 'texttype': texttype, 'token_count': token_count}
+                for idx, (text, texttype, token_count) in enumerate(actions)
+            ])
+            # positions left behind by an undo are overwritten in place
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[StoryAction.story_uuid, StoryAction.position],
+                set_={
+                    'text': stmt.excluded.text,
+                    'texttype': stmt.excluded.texttype,
+                    'token_count': stmt.excluded.token_count
+                }
+            ))
+
+        await session.flush()
 
-        return db_obj
-    
     async def delete_story(self, session: AsyncSession, uuid: str) -> Optional[Story]:
         db_obj = (await session.execute(select(self.model).where(self.model.uuid == uuid))).scalars().first()
 
@@ -85,7 +149,7 @@ class StoryCrud(CrudBase[Story, Story, StoryUpdate]):
             return None
 
         await session.delete(db_obj)
-        await session.commit()
+        await session.flush()
 
         return db_obj
 
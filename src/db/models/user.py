@@ -1,5 +1,6 @@
 from src.db.base_class import Base
-from sqlalchemy import Column, String, Table, BigInteger, Integer
+from sqlalchemy import Column, String, Table, BigInteger, Integer, ForeignKey, DateTime, LargeBinary, func, text
+from sqlalchemy.dialects.postgresql import JSONB
 
 class User(Base):
     __tablename__ = 'users'
@@ -14,5 +15,16 @@ class Story(Base):
 
     uuid = Column(String, primary_key=True, index=True, unique=True)
     owner_id = Column(BigInteger, index=True)
-    content_metadata = Column(String, unique=False)
-    content = Column(String, unique=False)
+    content_metadata = Column(JSONB, unique=False, server_default=text("'{}'::jsonb"), nullable=False) # updated field by field, see StoryCrud.update_metadata
+    content = Column(LargeBinary, unique=False) # compressed snapshot of the story, see ContentCodec. actions after it live in story_actions
+    activation = Column(String, unique=False, nullable=True) # activation state, saved every turn
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+class StoryAction(Base):
+    __tablename__ = 'story_actions'
+
+    story_uuid = Column(String, ForeignKey('stories.uuid', ondelete='CASCADE'), primary_key=True)
+    position = Column(Integer, primary_key=True, autoincrement=False) # index of the action in the story's entries
+    text = Column(String, unique=False)
+    texttype = Column(Integer, unique=False)
+    token_count = Column(Integer, unique=False, nullable=True)
@@ -1,3 +1,5 @@
+from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel
 
 class User(BaseModel):
@@ -9,8 +11,25 @@ class User(BaseModel):
 class Story(BaseModel):
     uuid: str
     owner_id: int
-    content_metadata: str
-    content: str
+    content_metadata: dict
+    content: bytes
+    activation: Optional[str]
+    updated_at: Optional[datetime]
+
+# a story without its content, as listed for its owner
+class StorySummary(BaseModel):
+    uuid: str
+    content_metadata: dict
+    content_bytes: int
+    actions: int
+    updated_at: Optional[datetime]
+
+class StoryAction(BaseModel):
+    story_uuid: str
+    position: int
+    text: str
+    texttype: int
+    token_count: Optional[int]
 
 class UserUpdate(BaseModel):
     gensettings: str
@@ -18,5 +37,5 @@ class UserUpdate(BaseModel):
     quota: int
 
 class StoryUpdate(BaseModel):
-    content_metadata: str
-    content: str
\ No newline at end of file
+    content_metadata: dict
+    content: bytes
\ No newline at end of file
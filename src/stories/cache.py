@@ -0,0 +1,246 @@
+import asyncio
+import time
+from collections import OrderedDict
+from src.core.config import settings
+from src.core.logging import get_logger
+from src.stories.db import current_work, unit_of_work
+
+logger = get_logger(__name__)
+
+# parsed users and stories kept between commands, an LRU bounded by their approximate size.
+# saves only mark an object dirty, dirty objects are written together on a timer and never
+# evicted before that
+class ObjectCache:
+    def __init__(self, max_bytes=64*1024*1024, max_idle=600.0, flush_interval=5.0):
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.flush_interval = flush_interval
+        self.entries = OrderedDict() # key -> [object, size, last used]
+        self.num_bytes = 0
+        self.dirty = {} # key -> object waiting to be written
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.saves = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[2] = time.monotonic()
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, obj):
+        if not self.enabled:
+            return
+        self.resize(key, obj)
+        self.evict()
+
+    # keeps the size of an object up to date, it grows with every action
+    def resize(self, key, obj):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+        size = obj.size()
+        self.entries[key] = [obj, size, time.monotonic()]
+        self.num_bytes += size
+
+    def mark_dirty(self, key, obj):
+        self.saves += 1
+        self.dirty[key] = obj
+        self.resize(key, obj)
+        self.evict()
+
+    def is_dirty(self, key):
+        return key in self.dirty
+
+    # the object for key if it has changes that are not written yet
+    def get_dirty(self, key):
+        return self.dirty.get(key)
+
+    # drops an object without writing it, e.g. after it was deleted
+    def discard(self, key):
+        self.dirty.pop(key, None)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[1]
+
+    def evict(self):
+        now = time.monotonic()
+        for key in list(self.entries.keys()):
+            if self.num_bytes <= self.max_bytes:
+                break
+            if key not in self.dirty:
+                self.discard(key)
+        for key, (_, _, last_used) in list(self.entries.items()):
+            if (now - last_used > self.max_idle) and (key not in self.dirty):
+                self.discard(key)
+
+    # writes every dirty object that no command holds in one transaction, objects that
+    # fail stay dirty
+    async def flush(self):
+        async with self.flush_lock:
+            pending = {key: obj for key, obj in self.dirty.items() if not object_locks.locked(key)}
+            if len(pending) == 0:
+                return
+            for key in pending:
+                del self.dirty[key]
+            start = time.perf_counter()
+            try:
+                async with unit_of_work():
+                    for obj in pending.values():
+                        await obj.flush()
+            except Exception:
+                # changes saved meanwhile are newer, keep those
+                for key, obj in pending.items():
+                    self.dirty.setdefault(key, obj)
+                raise
+            self.writes += len(pending)
+            logger.info(f'flushed {len(pending)} objects in {time.perf_counter() - start:.3f}s')
+        self.evict()
+
+    # puts back an object dropped by a command that failed
+    def restore(self, key, obj, dirty):
+        self.put(key, obj)
+        if dirty:
+            self.dirty.setdefault(key, obj)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'write behind flush failed: {e}')
+
+    # starts flushing on a timer, needs a running event loop
+    def start(self):
+        if self.enabled and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.get_running_loop().create_task(self.run())
+
+    # stops the timer and writes what is left
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if len(self.dirty) > 0:
+            logger.warning(f'{len(self.dirty)} objects held by running commands were not written')
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        return {
+            'objects': len(self.entries),
+            'bytes': self.num_bytes,
+            'dirty': len(self.dirty),
+            'hit_rate': self.hit_rate(),
+            'saves': self.saves,
+            'writes': self.writes
+        }
+
+# one lock per object key, held by the unit of work that recalled the object until it finishes
+class ObjectLocks:
+    def __init__(self):
+        self.locks = {} # key -> [lock, number of holders and waiters]
+
+    async def acquire(self, key):
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.unref(key, entry)
+            raise
+
+    def release(self, key):
+        entry = self.locks[key]
+        entry[0].release()
+        self.unref(key, entry)
+
+    def unref(self, key, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[key]
+
+    def locked(self, key):
+        entry = self.locks.get(key)
+        return entry is not None and entry[0].locked()
+
+object_locks = ObjectLocks()
+
+object_cache = ObjectCache(settings.OBJECT_CACHE_SIZE, settings.OBJECT_CACHE_IDLE, settings.OBJECT_CACHE_FLUSH_INTERVAL)
+
+# the object for key loaded by the running unit of work or held in the cache, if any. the
+# running unit of work locks key first, also when the object still has to be loaded
+async def recall(key):
+    work = current_work.get()
+    if work is not None:
+        if work.get(key) is not None:
+            return work.get(key)
+        if key not in work.locked:
+            await object_locks.acquire(key)
+            work.locked.add(key)
+            work.finished.append(lambda: object_locks.release(key))
+    obj = object_cache.get(key)
+    if obj is not None and work is not None:
+        remember(key, obj)
+    return obj
+
+# the object for key if the database does not have its latest changes yet, without
+# counting as a cache lookup
+def unwritten(key):
+    work = current_work.get()
+    if work is not None and key in work.dirty:
+        return work.dirty[key]
+    return object_cache.get_dirty(key)
+
+# makes a loaded object known to the running unit of work and the cache. a failed command
+# may have left the object half changed, it goes back to its state from before the command,
+# which keeps the changes of earlier commands that are not written yet
+def remember(key, obj):
+    work = current_work.get()
+    if work is not None:
+        work.add(key, obj)
+        obj.checkpoint()
+        work.rolled_back.append(obj.restore)
+        work.finished.append(obj.release)
+    object_cache.put(key, obj)
+
+# saves obj through the cache when it is enabled, after the running unit of work commits,
+# otherwise with the unit of work or right away
+async def save_object(key, obj):
+    work = current_work.get()
+    if object_cache.enabled:
+        if work is not None:
+            work.committed.append(lambda: object_cache.mark_dirty(key, obj))
+        else:
+            object_cache.mark_dirty(key, obj)
+    elif work is not None:
+        work.defer(key, obj)
+    else:
+        await obj.flush()
+
+# drops a deleted object, waiting for a flush that may be writing it. the object comes back
+# if the unit of work deleting it fails
+async def forget_object(key):
+    work = current_work.get()
+    if work is not None:
+        work.forget(key)
+    async with object_cache.flush_lock:
+        entry = object_cache.entries.get(key)
+        if (work is not None) and (entry is not None):
+            obj, dirty = entry[0], object_cache.is_dirty(key)
+            work.rolled_back.append(lambda: object_cache.restore(key, obj, dirty))
+        object_cache.discard(key)
@@ -0,0 +1,123 @@
+import time
+import zlib
+from src.core.config import settings
+from src.core.logging import get_logger
+from src.stories.workers import worker_pool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = get_logger(__name__)
+
+# first byte of encoded content, naming the codec of the rest
+CODEC_NONE=0
+CODEC_ZLIB=1
+CODEC_ZSTD=2
+
+CODEC_NAMES = {
+    'none': CODEC_NONE,
+    'zlib': CODEC_ZLIB,
+    'zstd': CODEC_ZSTD
+}
+
+# compresses stored story content. a leading byte names the codec, content stored before
+# compression starts with '{'
+class ContentCodec:
+    def __init__(self, codec='auto', level=None):
+        if codec == 'auto':
+            codec = 'zstd' if zstandard is not None else 'zlib'
+        if codec not in CODEC_NAMES:
+            raise ValueError(f'unknown content codec {codec}')
+        if (codec == 'zstd') and (zstandard is None):
+            raise ValueError('the zstd content codec needs the zstandard package')
+        self.name = codec
+        self.codec = CODEC_NAMES[codec]
+        self.level = level
+        self.raw_bytes = 0 # bytes before encoding
+        self.encoded_bytes = 0 # bytes after encoding
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.decoded = 0
+
+    def compress(self, data):
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=self.level if self.level is not None else 3).compress(data)
+        if self.codec == CODEC_ZLIB:
+            return zlib.compress(data, self.level if self.level is not None else 6)
+        return data
+
+    def decompress(self, codec, data):
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ValueError('story content is compressed with zstd, but the zstandard package is not installed')
+            return zstandard.ZstdDecompressor().decompress(data)
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec == CODEC_NONE:
+            return data
+        raise ValueError(f'unknown content codec {codec}')
+
+    def encode(self, text: str) -> bytes:
+        return bytes([self.codec]) + self.compress(text.encode('utf-8'))
+
+    def decode(self, data) -> str:
+        if isinstance(data, str):
+            # not converted to bytes yet
+            return data
+        data = bytes(data)
+        if (len(data) == 0) or (data[:1] == b'{'):
+            # stored before content was compressed
+            return data.decode('utf-8')
+        return self.decompress(data[0], data[1:]).decode('utf-8')
+
+    # encodes text, also returning its length in bytes and the time it took
+    def encode_timed(self, text: str):
+        start = time.perf_counter()
+        encoded = self.encode(text)
+        return encoded, len(text.encode('utf-8')), time.perf_counter() - start
+
+    def decode_timed(self, data):
+        start = time.perf_counter()
+        text = self.decode(data)
+        return text, time.perf_counter() - start
+
+    def record_encode(self, raw_bytes, encoded_bytes, elapsed):
+        self.raw_bytes += raw_bytes
+        self.encoded_bytes += encoded_bytes
+        self.encode_time += elapsed
+        logger.debug(f'encoded {raw_bytes} bytes of story content to {encoded_bytes} ({raw_bytes / encoded_bytes:.2f}x) in {elapsed:.4f}s')
+
+    def record_decode(self, elapsed):
+        self.decode_time += elapsed
+        self.decoded += 1
+        logger.debug(f'decoded story content in {elapsed:.4f}s')
+
+    # how many times smaller the encoded content is
+    def ratio(self):
+        return self.raw_bytes / self.encoded_bytes if self.encoded_bytes > 0 else 0.0
+
+    def stats(self):
+        return {
+            'codec': self.name,
+            'ratio': self.ratio(),
+            'raw_bytes': self.raw_bytes,
+            'encoded_bytes': self.encoded_bytes,
+            'encode_time': self.encode_time,
+            'decode_time': self.decode_time,
+            'decoded': self.decoded
+        }
+
+content_codec = ContentCodec(settings.CONTENT_CODEC)
+
+# encodes and decodes story content in a worker, off the event loop
+async def encode_content(text: str) -> bytes:
+    encoded, raw_bytes, elapsed = await worker_pool.run(content_codec.encode_timed, text)
+    content_codec.record_encode(raw_bytes, len(encoded), elapsed)
+    return encoded
+
+async def decode_content(data) -> str:
+    text, elapsed = await worker_pool.run(content_codec.decode_timed, data)
+    content_codec.record_decode(elapsed)
+    return text
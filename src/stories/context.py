@@ -1,7 +1,13 @@
 import json
+import os
 import re
-from transformers import AutoTokenizer
-tokenizer = AutoTokenizer.from_pretrained('gpt2')
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import accumulate
+from src.stories.retrieval import BM25Index
+from src.stories.rope import Piece, Rope
+from src.stories.tokenizer import tokenizer_service
 
 TRIM_DIR_TOP=0
 TRIM_DIR_BOTTOM=1
@@ -15,93 +21,119 @@ INSERTION_TYPE_NEWLINE=6
 INSERTION_TYPE_SENTENCE=7
 INSERTION_TYPE_TOKEN=8
 
+ACTIVATION_MODE_KEYS=9
+ACTIVATION_MODE_RETRIEVAL=10
+
 def split_into_sentences(str):
     # preserve line breaks too
     return re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s', str)
 
+# character offsets where each sentence returned by split_into_sentences begins
+def sentence_offsets(sentences):
+    offsets = []
+    offset = 0
+    for sentence in sentences:
+        offsets.append(offset)
+        # split_into_sentences consumes exactly one whitespace character between sentences
+        offset += len(sentence) + 1
+    return offsets
+
+# index of every insertion type in the boundaries of a context piece
+INSERTION_KINDS = {
+    INSERTION_TYPE_NEWLINE: 0,
+    INSERTION_TYPE_SENTENCE: 1,
+    INSERTION_TYPE_TOKEN: 2,
+}
+
+# builds a context piece out of lines, with boundaries for the given insertion types only
+def context_piece(lines, insertion_types):
+    text = '\n'.join(lines) + '\n'
+    newlines = [match.end() for match in re.finditer('\n', text)]
+    sentences = []
+    tokens = []
+    if INSERTION_TYPE_SENTENCE in insertion_types:
+        # every line ends a sentence too
+        offsets = sentence_offsets(split_into_sentences(text))
+        sentences = sorted(set(i for i in offsets if 0 < i <= len(text)).union(newlines))
+    if INSERTION_TYPE_TOKEN in insertion_types:
+        _, spans = tokenizer_service.encode_offsets(text)
+        tokens = [span[0] for span in spans if span[0] > 0] + [len(text)]
+    return Piece(text, (newlines, sentences, tokens))
+
+# number of tokens text[begin:] encodes to, given the token starts of all of text. The
+# cut may split a token, e.g. a separator merged into the next word or a run of newlines,
+# so a short window after the cut is encoded until its tokens line up with the full
+# encoding again; from there on both encodings are the same.
+def suffix_token_count(text, starts, begin, window=64):
+    while True:
+        end = min(begin + window, len(text))
+        _, spans = tokenizer_service.encode_offsets(text[begin:end])
+        if end == len(text):
+            return len(spans)
+        # the last token of the window may be cut short, so it cannot be the one that lines up
+        for count, span in enumerate(spans[1:-1], 1):
+            token_idx = bisect_left(starts, begin + span[0])
+            if (token_idx < len(starts)) and (starts[token_idx] == begin + span[0]):
+                return count + len(starts) - token_idx
+        window *= 2
+
 def trim_newlines(tokens, trim_dir, limit):
     if (trim_dir == TRIM_DIR_NONE) or (len(tokens) <= limit):
         return tokens
     
-    lines = tokenizer.decode(tokens).split('\n')
-    start, end, step = 0, 0, 0
+    lines = tokenizer_service.decode(tokens).split('\n')
     if trim_dir == TRIM_DIR_TOP:
-        start = len(lines) - 1
-        end = -1
-        step = -1
+        # lines are kept from the bottom up, each with the newline in front of it
+        lines = ['\n' + line for line in reversed(lines)]
     elif trim_dir == TRIM_DIR_BOTTOM:
-        start = 0
-        end = len(lines)
-        step = 1
-    
-    acc_tokens = []
-
-    for idx in range(start, end, step):
-        line = lines[idx]
-        if trim_dir == TRIM_DIR_TOP:
-            line = '\n' + line
-        elif trim_dir == TRIM_DIR_BOTTOM:
-            line = line + '\n'
-        new_tokens = tokenizer.encode(line)
-        if len(new_tokens) + len(acc_tokens) > limit:
-            return acc_tokens
-        else:
-            if trim_dir == TRIM_DIR_TOP:
-                acc_tokens = new_tokens + acc_tokens
-            elif trim_dir == TRIM_DIR_BOTTOM:
-                acc_tokens = acc_tokens + new_tokens
-    return acc_tokens
+        lines = [line + '\n' for line in lines]
+    else:
+        return tokens
+
+    # every line is encoded on its own, all of them in one batch, so the kept lines are
+    # exactly the ones whose token counts add up to at most limit
+    encoded = [ids for ids, _ in tokenizer_service.encode_batch(lines)]
+    kept = bisect_right(list(accumulate(len(ids) for ids in encoded)), limit)
+    if trim_dir == TRIM_DIR_TOP:
+        encoded = encoded[kept - 1::-1] if kept > 0 else []
+    else:
+        encoded = encoded[:kept]
+    return [i for ids in encoded for i in ids]
 
 def trim_sentences(tokens, trim_dir, limit):
     if (trim_dir == TRIM_DIR_NONE) or (len(tokens) <= limit):
         return tokens
     
-    text = tokenizer.decode(tokens)
+    text = tokenizer_service.decode(tokens)
     sentences = split_into_sentences(text)
+    offsets = sentence_offsets(sentences)
 
-    start, end, step = 0, 0, 0
-    text_begin, text_end = 0, 0
-    sentence_idx, last_sentence_idx = 0, 0
+    # tokenize once, the token count on either side of a cut is then mostly a bisect away.
+    # only the text that is kept gets encoded again.
+    _, spans = tokenizer_service.encode_offsets(text)
+    starts = [span[0] for span in spans]
 
     if trim_dir == TRIM_DIR_TOP:
-        start = len(sentences) - 1
-        end = -1
-        step = -1
-        text_begin = 0
-        text_end = len(text)
-    elif trim_dir == TRIM_DIR_BOTTOM:
-        start = 0
-        end = len(sentences)
-        step = 1
-        text_begin = 0
         text_end = len(text)
-    else:
-        return tokens
-    
-    for idx in range(start, end, step):
-        sentence = sentences[idx]
-        if trim_dir == TRIM_DIR_TOP:
-            sentence_idx = text.rindex(sentence) + text_begin
+        for idx in range(len(sentences) - 1, -1, -1):
+            sentence_idx = offsets[idx]
             if (sentence_idx > 0) and (sentence_idx < len(text)) and (text[sentence_idx] == ' '):
                 sentence_idx -= 1
-            to_tokenize = text[sentence_idx:]
-            token_count = len(tokenizer.encode(to_tokenize))
+            token_count = suffix_token_count(text, starts, sentence_idx)
             if token_count >= limit:
-                to_encode = text[text_end:]
-                return tokenizer.encode(to_encode)
-            text_end = sentence_idx - 1
-        elif trim_dir == TRIM_DIR_BOTTOM:
-            sentence_idx = text.index(sentence) + text_begin
-            sentence_end = sentence_idx + len(sentence)
-            if (sentence_end < text_end) and (text[sentence_end:sentence_end+1] == '\n'):
+                return tokenizer_service.encode(text[text_end:])
+            # keep the separator in front of the sentence
+            text_end = max(sentence_idx - 1, 0)
+    elif trim_dir == TRIM_DIR_BOTTOM:
+        last_sentence_idx = 0
+        for idx in range(len(sentences)):
+            sentence_end = offsets[idx] + len(sentences[idx])
+            if (sentence_end < len(text)) and (text[sentence_end] == '\n'):
                 sentence_end += 1
-            to_tokenize = text[0:sentence_end]
-            token_count = len(tokenizer.encode(to_tokenize))
+            token_count = bisect_left(starts, sentence_end)
             if token_count >= limit:
-                to_encode = text[0:last_sentence_idx]
-                return tokenizer.encode(to_encode)
+                return tokenizer_service.encode(text[0:last_sentence_idx])
             last_sentence_idx = sentence_end
-            text_begin += len(sentence)
     return tokens
 
 def trim_tokens(tokens, trim_dir, limit):
@@ -113,7 +145,7 @@ def trim_tokens(tokens, trim_dir, limit):
         return tokens[:limit]
 
 class ContextEntry:
-    def __init__(self, keys=[''], text='', prefix='', suffix='\n', token_budget=2048, reserved_tokens=0, insertion_order=100, insertion_position=-1, trim_direction=TRIM_DIR_BOTTOM, trim_type=TRIM_TYPE_SENTENCE, insertion_type=INSERTION_TYPE_SENTENCE, forced_activation=False, cascading_activation=False):
+    def __init__(self, keys=[''], text='', prefix='', suffix='\n', token_budget=2048, reserved_tokens=0, insertion_order=100, insertion_position=-1, trim_direction=TRIM_DIR_BOTTOM, trim_type=TRIM_TYPE_SENTENCE, insertion_type=INSERTION_TYPE_SENTENCE, forced_activation=False, cascading_activation=False, search_range=None, id=None):
         self.keys = keys # key used to activate this context entry 
         self.text = prefix + text + suffix # text associated with this context entry
         self.token_budget = token_budget # max amount of tokens that this context entry can use
@@ -125,14 +157,26 @@ class ContextEntry:
         self.insertion_type = insertion_type # determines what units are used to insert the text
         self.forced_activation = forced_activation # if True, this context entry is activated even if it is not activated
         self.cascading_activation = cascading_activation # when activated, this context entry will search for other entries and activate them if found
+        self.search_range = search_range # number of trailing characters of a text searched for this entry's keys, None searches all of it
+        self.id = id # stable identifier of this context entry, used to persist its activation
         if self.text == '':
             suffix = ''
             prefix = ''
     
+    # trims tokens of this context entry's text down to limit tokens
+    def trim_to(self, tokens, limit):
+        if self.trim_type == TRIM_TYPE_NEWLINE:
+            tokens = trim_newlines(tokens, self.trim_direction, limit)
+        elif self.trim_type == TRIM_TYPE_SENTENCE:
+            tokens = trim_sentences(tokens, self.trim_direction, limit)
+        elif self.trim_type == TRIM_TYPE_TOKEN:
+            tokens = trim_tokens(tokens, self.trim_direction, limit)
+        return tokens
+
     # max_length is in tokens
     def trim(self, max_length, token_budget):
         target = 0
-        tokens = tokenizer.encode(self.text)
+        tokens = tokenizer_service.encode(self.text)
         num_tokens = len(tokens)
         projected = max_length - num_tokens
         if projected > token_budget:
@@ -141,21 +185,185 @@ class ContextEntry:
             target = num_tokens
         else:
             target = max_length
-        if self.trim_type == TRIM_TYPE_NEWLINE:
-            tokens = trim_newlines(tokens, self.trim_direction, target)
-        elif self.trim_type == TRIM_TYPE_SENTENCE or len(tokens) > target:
-            tokens = trim_sentences(tokens, self.trim_direction, target)
-        elif self.trim_type == TRIM_TYPE_TOKEN or len(tokens) > target:
-            tokens = trim_tokens(tokens, self.trim_direction, target)
-        return tokens
+        return self.trim_to(tokens, target)
         
     def get_text(self, max_length, token_budget):
-        return tokenizer.decode(self.trim(max_length, token_budget))
+        return tokenizer_service.decode(self.trim(max_length, token_budget))
+
+class EntryAllocation:
+    def __init__(self, entry, num_tokens):
+        self.entry = entry
+        self.num_tokens = num_tokens # tokens in the untrimmed text
+        self.reserved = 0 # tokens set aside for the entry before anything is allotted
+        self.allotted = 0 # tokens the entry may use, reservation included
+        self.used = 0 # tokens the entry uses once trimmed
+
+    def __repr__(self):
+        return f'<EntryAllocation num_tokens={self.num_tokens} reserved={self.reserved} allotted={self.allotted} used={self.used}>'
+
+# token allocation for the activated entries of a context, highest insertion_order first
+class BudgetPlan:
+    def __init__(self, budget):
+        self.budget = budget
+        self.allocations = []
+        self.by_entry = {}
+
+    def add(self, allocation):
+        self.allocations.append(allocation)
+        self.by_entry[allocation.entry] = allocation
+
+    def __getitem__(self, entry):
+        return self.by_entry[entry]
+
+    def __iter__(self):
+        return iter(self.allocations)
+
+    def allotted(self):
+        return sum(allocation.allotted for allocation in self.allocations)
+
+    def used(self):
+        return sum(allocation.used for allocation in self.allocations)
+
+# aho-corasick automaton finding every key in a text in one pass, case-insensitive
+class KeywordAutomaton:
+    def __init__(self):
+        self.goto = [{}] # state -> {character: next state}
+        self.fail = [0] # state -> longest proper suffix that is also a state
+        self.output = [()] # state -> values of the keys that end at this state
+
+    def add_key(self, key, value):
+        state = 0
+        for ch in key.lower():
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+                self.goto[state][ch] = next_state
+            state = next_state
+        self.output[state] += (value,)
+        return self
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+        return self
+
+    # returns the values of every key found in text
+    def scan(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        if len(goto) == 1:
+            return found
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    # returns, for the value of every key found in text, where its last match ends
+    def scan_ends(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        ends = {}
+        if len(goto) == 1:
+            return ends
+        state = 0
+        for pos, ch in enumerate(text.lower()):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for value in output[state]:
+                ends[value] = pos + 1
+        return ends
+
+# finds the entries whose keys appear in a text, one automaton per search_range so each
+# group only scans the tail it can match in
+class KeywordIndex:
+    def __init__(self, entries):
+        self.entries = entries
+        self.positions = {entry: idx for idx, entry in enumerate(entries)}
+        self.graph = None # entry index -> indices of the entries its text activates
+        self.max_key_length = 0
+        automatons = {}
+        for idx, entry in enumerate(entries):
+            for key in entry.keys:
+                if key == '':
+                    continue
+                if entry.search_range not in automatons:
+                    automatons[entry.search_range] = KeywordAutomaton()
+                automatons[entry.search_range].add_key(key, (idx, len(key)))
+                self.max_key_length = max(self.max_key_length, len(key))
+        self.groups = [(search_range, automaton.build()) for search_range, automaton in automatons.items()]
+        # widest tail of a text any entry can be activated from, None if an entry searches all of it
+        self.max_search_range = 0
+        for search_range, _ in self.groups:
+            if (search_range is None) or (self.max_search_range is None):
+                self.max_search_range = None
+            else:
+                self.max_search_range = max(self.max_search_range, search_range)
+
+    # precomputes which entries every entry's text activates, for entries with static text.
+    # cascading ignores search_range, so whole entry texts are scanned.
+    def build_graph(self):
+        self.graph = [tuple(sorted(self.scan(entry.text, windowed=False))) for entry in self.entries]
+
+    # returns the indices of every entry with a key found in text, or in the last
+    # search_range characters of it when windowed
+    def scan(self, text, windowed=True):
+        found = set()
+        for search_range, automaton in self.groups:
+            window = text
+            if windowed and (search_range is not None):
+                window = text[max(len(text) - search_range, 0):]
+            found.update(idx for idx, _ in automaton.scan(window))
+        return found
+
+    # returns, for every entry with a key found in text, where its last match starts.
+    # offset is added to every position, for texts that are a slice of a longer one.
+    def last_matches(self, text, offset=0):
+        matches = {}
+        for _, automaton in self.groups:
+            for (idx, length), end in automaton.scan_ends(text).items():
+                start = offset + end - length
+                if matches.get(idx, -1) < start:
+                    matches[idx] = start
+        return matches
+
+    def match(self, text):
+        return [self.entries[idx] for idx in sorted(self.scan(text))]
+
+    # returns the entries activated by entry's text, from the graph when it covers entry
+    def cascade(self, entry):
+        if (self.graph is not None) and (entry in self.positions):
+            return [self.entries[idx] for idx in self.graph[self.positions[entry]]]
+        return self.match(entry.text)
 
 class ContextManager:
-    def __init__(self, token_budget=1024):
+    def __init__(self, token_budget=1024, cascade_depth=None, activation_mode=ACTIVATION_MODE_KEYS, retrieval_top_k=8, retrieval_budget=None, retrieval_window=1000):
         self.token_budget = token_budget
+        self.cascade_depth = cascade_depth # max rounds of cascading activation, None runs to a fixed point
+        self.activation_mode = activation_mode # how lorebook entries are activated by the text of cascading entries
+        self.retrieval_top_k = retrieval_top_k # max number of lorebook entries activated by retrieval
+        self.retrieval_budget = retrieval_budget # max tokens of lorebook entries activated by retrieval, None uses a quarter of token_budget
+        self.retrieval_window = retrieval_window # number of trailing characters of each cascading entry used as the retrieval query
         self.entries = []
+        self.lorebooks = []
+        self.indexes = [] # prebuilt keyword indexes, one per lorebook
+        self.indexed = set() # entries covered by self.indexes
+        self.activated = [] # entries the caller already found to be activated
+        self.plan = None # budget plan of the last context built
     
     def add_entry(self, entry):
         self.entries.append(entry)
@@ -169,23 +377,121 @@ class ContextManager:
     def del_entries(self, entries):
         for entry in entries:
             self.del_entry(entry)
+
+    # adds a lorebook's entries along with the keyword index compiled when it was loaded
+    def add_lorebook(self, lorebook):
+        self.add_entries(lorebook.entries)
+        self.lorebooks.append(lorebook)
+        self.indexes.append(lorebook.index)
+        self.indexed.update(lorebook.entries)
     
-    # return true if key is found in an entry's text. checks if entry_b's keys are found in entry_a's text
-    def key_lookup(self, entry_a, entry_b):
-        for i in entry_b.keys:
-            if i == '':
-                continue
-            if i.lower() in entry_a.text.lower():
-                return True
-        return False
-    
+    # marks entries as activated by a caller that searched for their keys itself
+    def activate_entries(self, entries):
+        self.activated.extend(entries)
+
+    # keyword indexes covering every entry, entries added one by one get a fresh index
+    def key_indexes(self):
+        loose = [i for i in self.entries if i not in self.indexed]
+        return self.indexes + [KeywordIndex(loose)]
+
+    # returns every entry with a key found in text
+    def text_lookup(self, text, indexes=None):
+        if indexes is None:
+            indexes = self.key_indexes()
+        found = []
+        for index in indexes:
+            found.extend(index.match(text))
+        return found
+
     # function that searches for other entries that are activated
-    def cascade_lookup(self, entry):
-        cascaded_entries = []
+    def cascade_lookup(self, entry, indexes=None):
+        if indexes is None:
+            indexes = self.key_indexes()
+        found = []
+        for index in indexes:
+            found.extend(index.cascade(entry))
+        return found
+
+    # ranks lorebook entries against text and returns the best ones that fit the retrieval budget
+    def retrieve(self, text):
+        token_budget = self.retrieval_budget
+        if token_budget is None:
+            token_budget = self.token_budget // 4
+        retrieved = []
+        for lorebook in self.lorebooks:
+            retrieved.extend(lorebook.retrieve(text, self.retrieval_top_k, token_budget))
+        return retrieved
+
+    # activates forced entries, then walks breadth first through every entry activated by a
+    # cascading entry until nothing new is found or cascade_depth rounds have run. lorebook
+    # entries follow their precomputed cascade graph, other entries have their text scanned.
+    def activate(self):
+        indexes = self.key_indexes()
+        present = set(self.entries)
+        activated = {}
+        frontier = []
         for i in self.entries:
-            if self.key_lookup(entry, i):
-                cascaded_entries.append(i)
-        return cascaded_entries
+            if i.forced_activation:
+                activated[i] = True
+                if i.cascading_activation:
+                    frontier.append(i)
+        for i in self.activated:
+            if (i in activated) or (i not in present):
+                continue
+            activated[i] = True
+            if i.cascading_activation:
+                frontier.append(i)
+        depth = 0
+        if (self.activation_mode == ACTIVATION_MODE_RETRIEVAL) and frontier:
+            # lorebook entries are ranked against the text of the cascading entries instead of
+            # matching their keys, entries added one by one still match by key
+            query = '\n'.join(i.text[-self.retrieval_window:] for i in frontier)
+            found = self.retrieve(query)
+            for i in frontier:
+                found.extend(self.cascade_lookup(i, indexes[len(self.indexes):]))
+            frontier = []
+            for j in found:
+                if (j in activated) or (j not in present):
+                    continue
+                activated[j] = True
+                if j.cascading_activation:
+                    frontier.append(j)
+            depth += 1
+        while frontier and ((self.cascade_depth is None) or (depth < self.cascade_depth)):
+            depth += 1
+            newly_activated = []
+            for i in frontier:
+                for j in self.cascade_lookup(i, indexes):
+                    if (j in activated) or (j not in present):
+                        continue
+                    activated[j] = True
+                    if j.cascading_activation:
+                        newly_activated.append(j)
+            frontier = newly_activated
+        return list(activated)
+
+    # plans how many tokens every entry may use in one pass over precomputed token counts.
+    # reserved tokens are set aside first, by insertion_order, as far as the budget allows.
+    # then every entry, by insertion_order, is allotted up to its token_budget out of its
+    # reservation and whatever nobody reserved. entries are trimmed afterwards, only once.
+    def plan_budget(self, entries, budget):
+        plan = BudgetPlan(budget)
+        # every entry text, the story included, is encoded in one batch
+        encodings = tokenizer_service.encode_batch([i.text for i in entries])
+        for i, (ids, _) in zip(entries, encodings):
+            plan.add(EntryAllocation(i, len(ids)))
+
+        remaining = budget
+        for allocation in plan:
+            wanted = min(allocation.num_tokens, allocation.entry.token_budget)
+            allocation.reserved = max(min(allocation.entry.reserved_tokens, wanted, remaining), 0)
+            remaining -= allocation.reserved
+
+        for allocation in plan:
+            wanted = min(allocation.num_tokens, allocation.entry.token_budget)
+            allocation.allotted = max(min(wanted, allocation.reserved + remaining), 0)
+            remaining -= allocation.allotted - allocation.reserved
+        return plan
 
     # handles cases where elements are added to the end of a list using list.insert
     def ordinal_pos(self, position, length):
@@ -196,78 +502,109 @@ class ContextManager:
     def context(self, budget=1024):
         # sort self.entries by insertion_order
         self.entries.sort(key=lambda x: x.insertion_order, reverse=True)
-        activated_entries = []
-
-        # Get entries activated by default
-        for i in self.entries:
-            if i.forced_activation:
-                if i.cascading_activation:
-                    for j in self.cascade_lookup(i):
-                        activated_entries.append(j)
-                    activated_entries.append(i)
-                else:
-                    activated_entries.append(i)
-            if i.insertion_position > 0 or i.insertion_position < 0:
-                if i.reserved_tokens == 0:
-                    i.reserved_tokens = len(tokenizer.encode(i.text))
-        
-        activated_entries = list(set(activated_entries))
+        activated_entries = self.activate()
         # sort activated_entries by insertion_order
         activated_entries.sort(key=lambda x: x.insertion_order, reverse=True)
 
-        newctx = []
-        for i in activated_entries:
-            reserved = 0
-            if i.reserved_tokens > 0:
-                len_tokens = len(tokenizer.encode(i.text))
-                if len_tokens < i.reserved_tokens:
-                    budget -= len_tokens
-                else:
-                    budget -= i.reserved_tokens
-                if len_tokens > i.reserved_tokens:
-                    reserved = i.reserved_tokens
-                else:
-                    reserved = len_tokens
-            
-            text = i.get_text(budget + reserved, self.token_budget)
-            ctxtext = text.splitlines(keepends=False)
-            trimmed_tokenized = tokenizer.encode(text)
-            budget -= len(trimmed_tokenized) - reserved
-            ctxinsertion = i.insertion_position
-
-            before = []
-            after = []
-
-            if i.insertion_position < 0:
-                ctxinsertion += 1
-                if len(newctx) + ctxinsertion >= 0:
-                    before = newctx[0:len(newctx)+ctxinsertion]
-                    after = newctx[len(newctx)+ctxinsertion:]
-                else:
-                    before = []
-                    after = newctx[0:]
-            else:
-                before = newctx[0:ctxinsertion]
-                after = newctx[ctxinsertion:]
+        plan = self.plan_budget(activated_entries, budget)
+        self.plan = plan
 
-            newctx = []
+        # only compute the boundaries some entry is going to be inserted at
+        insertion_types = set(i.insertion_type for i in activated_entries)
+        rope = Rope()
+        carry = 0 # tokens left over by entries that trimmed below their allotment
+        for allocation in plan:
+            i = allocation.entry
+            tokens = tokenizer_service.encode(i.text)
+            limit = min(allocation.allotted + carry, allocation.num_tokens, i.token_budget)
+            if len(tokens) > limit:
+                tokens = i.trim_to(tokens, limit)
+            allocation.used = len(tokens)
+            carry += allocation.allotted - allocation.used
+
+            text = tokenizer_service.decode(tokens)
+            lines = text.splitlines(keepends=False)
+            if len(lines) == 0:
+                continue
 
-            for bIdx in range(len(before)):
-                newctx.append(before[bIdx])
-            for cIdx in range(len(ctxtext)):
-                newctx.append(ctxtext[cIdx])
-            for aIdx in range(len(after)):
-                newctx.append(after[aIdx])
-        return '\n'.join(newctx).rstrip().lstrip()
+            # insertion_position counts lines, sentences or tokens of what is assembled so far
+            kind = INSERTION_KINDS.get(i.insertion_type, INSERTION_KINDS[INSERTION_TYPE_NEWLINE])
+            total = rope.count(kind)
+            position = max(min(self.ordinal_pos(i.insertion_position, total), total), 0)
+            rope.insert(kind, position, context_piece(lines, insertion_types))
+        return rope.text().rstrip().lstrip()
 
 class Lorebook:
     def __init__(self, filepath) -> None:
+        self.filepath = filepath
+        self.mtime = os.stat(filepath).st_mtime_ns
         with open(filepath, encoding='utf-8') as fp:
             self.lorebook = json.load(fp)
-    
+        self.entries = self.parse_entries()
+        self.ids = {entry.id: entry for entry in self.entries}
+        self.index = KeywordIndex(self.entries)
+        self.index.build_graph()
+        self.retrieval = BM25Index([' '.join(entry.keys) + '\n' + entry.text for entry in self.entries])
+        self.load_tokens()
+
+    # entries are shared between every story using this lorebook and must not be mutated
     def get_entries(self):
+        return list(self.entries)
+
+    # returns the entries ranked best against text by BM25, up to top_k of them and as many
+    # as fit in token_budget
+    def retrieve(self, text, top_k, token_budget=None):
+        retrieved = []
+        used = 0
+        ranked = [self.entries[idx] for idx in self.retrieval.top_k(text, top_k)]
+        encodings = tokenizer_service.encode_batch([entry.text for entry in ranked])
+        for entry, (ids, _) in zip(ranked, encodings):
+            num_tokens = len(ids)
+            if (token_budget is not None) and (used + num_tokens > token_budget):
+                continue
+            used += num_tokens
+            retrieved.append(entry)
+        return retrieved
+
+    def sidecar_path(self):
+        return self.filepath + '.cache'
+
+    # tokenizes every entry into the shared token cache, reusing the precompiled sidecar
+    # file next to the lorebook for entries whose text has not changed
+    def load_tokens(self):
+        sidecar = {}
+        try:
+            with open(self.sidecar_path(), encoding='utf-8') as fp:
+                compiled = json.load(fp)
+            if compiled.get('tokenizer') == tokenizer_service.name:
+                sidecar = compiled['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        compiled = {}
+        missing = []
+        for entry in self.entries:
+            key = tokenizer_service.key(entry.text).hex()
+            if key in sidecar:
+                ids, spans = sidecar[key]
+                tokenizer_service.put(entry.text, ids, spans)
+                compiled[key] = [ids, spans]
+            else:
+                missing.append((key, entry.text))
+        encodings = tokenizer_service.encode_batch([text for _, text in missing])
+        for (key, _), (ids, spans) in zip(missing, encodings):
+            compiled[key] = [ids, spans]
+
+        if compiled.keys() != sidecar.keys():
+            try:
+                with open(self.sidecar_path(), 'w', encoding='utf-8') as fp:
+                    json.dump({'tokenizer': tokenizer_service.name, 'entries': compiled}, fp)
+            except OSError:
+                pass
+
+    def parse_entries(self):
         entries = []
-        for entry in self.lorebook['entries']:
+        for idx, entry in enumerate(self.lorebook['entries']):
             trimdir = entry['contextConfig']['trimDirection']
             insertiontype = entry['contextConfig']['insertionType']
             trimtype = entry['contextConfig']['maximumTrimType']
@@ -305,7 +642,36 @@ class Lorebook:
                     trim_type=trimtype,
                     insertion_type=insertiontype,
                     forced_activation=entry['forceActivation'],
-                    cascading_activation=entry['nonStoryActivatable']
+                    cascading_activation=entry['nonStoryActivatable'],
+                    search_range=entry.get('searchRange'),
+                    id=entry.get('id', str(idx))
                 )
             )
         return entries
+
+# loads each lorebook once per process and reloads it when its mtime changes, thread safe
+class LorebookRegistry:
+    def __init__(self):
+        self.lorebooks = {}
+        self.lock = threading.Lock()
+
+    def get(self, filepath):
+        filepath = os.path.abspath(filepath)
+        with self.lock:
+            lorebook = self.lorebooks.get(filepath)
+            if (lorebook is None) or (lorebook.mtime != os.stat(filepath).st_mtime_ns):
+                lorebook = Lorebook(filepath)
+                self.lorebooks[filepath] = lorebook
+            return lorebook
+
+    # mtime of the loaded copy of a lorebook, None before it is loaded. does not check the
+    # file, the next get does
+    def version(self, filepath):
+        with self.lock:
+            lorebook = self.lorebooks.get(os.path.abspath(filepath))
+            return lorebook.mtime if lorebook is not None else None
+
+lorebooks = LorebookRegistry()
+
+def get_lorebook(filepath):
+    return lorebooks.get(filepath)
@@ -1,12 +1,12 @@
+import functools
 import json
 
-from src.stories.db import (
-    user_create, user_update, user_delete, user_get,
-    story_create, story_update, story_delete, story_get
-)
-from src.stories.story import STORY_TEXTTYPE_ALTERED, STORY_TEXTTYPE_USER, StoryMetadataV1, StoryContentV1, Story
+from src.stories.db import user_get, story_get_metadata, story_update_metadata, unit_of_work
+from src.stories.cache import recall, remember
+from src.stories.story import STORY_TEXTTYPE_ALTERED, STORY_TEXTTYPE_USER, StoryMetadataV1, StoryContentV1, Story, count_entry_tokens, parse_metadata
 from src.stories.user import User
 from src.stories.api import ModelProvider
+from src.stories.workers import worker_pool
 from src.core.config import settings
 from src.core.logging import get_logger
 
@@ -32,19 +32,40 @@ def save_cache():
     with open(settings.CURRENT_STORY_CACHE, 'w') as f:
         json.dump(current_stories, f)
 
+# runs a command as one unit of work: one session, every user and story loaded at most
+# once and a single commit at the end. commands called from another command, or from a
+# caller that opened a unit of work itself, join the running one
+def command(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        async with unit_of_work():
+            return await fn(*args, **kwargs)
+    return wrapper
+
+# users and stories come from the running unit of work or the object cache before the
+# database, and are parsed once per load
 async def get_user(id: int=None):
     if id is None:
         raise ValueError('id is required')
-    if await user_get(id) is None:
+    user = await recall(('user', id))
+    if user is not None:
+        return user
+    row = await user_get(id)
+    if row is None:
         return None
     
-    user = User(0)
-    await user.load(id)
+    user = User(id)
+    user.load_row(row)
+    remember(('user', id), user)
     return user
 
 async def get_story(uuid: str=None):
+    story = await recall(('story', uuid))
+    if story is not None:
+        return story
     story = Story(uuid, id)
     await story.load(uuid)
+    remember(('story', uuid), story)
     return story
 
 async def get_current_story(id: int=None):
@@ -54,13 +75,45 @@ async def get_current_story(id: int=None):
     story = await get_story(uuid)
     return story
 
+# the metadata of the selected story, from memory or read alone from the database, so
+# viewing the memory or author's note does not load the story content
+async def get_current_story_metadata(id: int=None):
+    if id not in current_stories:
+        raise ValueError('A story must be selected using !selectstory')
+    uuid = current_stories[id]
+    story = await recall(('story', uuid))
+    if story is not None:
+        return story.content_metadata
+    content_metadata = await story_get_metadata(uuid)
+    if content_metadata is None:
+        raise ValueError('story not found')
+    return parse_metadata(content_metadata)
+
+# changes metadata fields of a story without loading or writing its content and returns
+# the changed metadata. a story already in memory is changed there and saved, otherwise
+# only the given fields of the stored metadata are updated
+async def update_story_metadata(uuid: str, **fields):
+    story = await recall(('story', uuid))
+    if story is not None:
+        if len(fields) > 0:
+            story.set_metadata(**fields)
+            await story.save()
+        return story.content_metadata
+    if len(fields) == 0:
+        return None
+    content_metadata = await story_update_metadata(uuid, fields)
+    if content_metadata is None:
+        raise ValueError('story not found')
+    return parse_metadata(content_metadata)
+
 # account commands
 
 # !register
+@command
 async def cmd_user_register(id: int=None):
     if id is None:
         raise ValueError('id is required')
-    if await user_get(id) is not None:
+    if await get_user(id) is not None:
         raise ValueError('user already exists')
     
     user = User(id)
@@ -68,6 +121,7 @@ async def cmd_user_register(id: int=None):
     return user
 
 # !deleteaccount
+@command
 async def cmd_user_delete(id: int=None):
     user = await get_user(id)
     if user is None:
@@ -75,6 +129,7 @@ async def cmd_user_delete(id: int=None):
     await user.delete()
 
 # !settings
+@command
 async def cmd_user_settings(id: int=None):
     user = await get_user(id)
     if user is None:
@@ -84,6 +139,7 @@ async def cmd_user_settings(id: int=None):
 # story commands
 
 # !newstory
+@command
 async def cmd_story_new(id: int=None, title: str=None, description: str=None, author: str=None, genre: str=None, tags: str=None, style: str=None):
     user = await get_user(id)
     if user is None:
@@ -103,6 +159,7 @@ async def cmd_story_new(id: int=None, title: str=None, description: str=None, au
     return story.story_uuid
 
 # !deletestory
+@command
 async def cmd_story_delete(id: int=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -111,6 +168,7 @@ async def cmd_story_delete(id: int=None):
     await user.delete_story(uuid)
 
 # !selectstory
+@command
 async def cmd_story_select(id: int=None, uuid: str=None):
     user = await get_user(id)
     if uuid not in user.storyids:
@@ -121,11 +179,13 @@ async def cmd_story_select(id: int=None, uuid: str=None):
     return story
 
 # !liststory
+@command
 async def cmd_story_list(id: int=None):
     user = await get_user(id)
-    return await user.get_stories()
+    return await user.list_stories()
 
 # !submit
+@command
 async def cmd_story_submit(id: int=None, context: str=None, provider: ModelProvider=None, generate: bool=True):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -138,14 +198,15 @@ async def cmd_story_submit(id: int=None, context: str=None, provider: ModelProvi
         if context != None:
             context = prefix + context
     if generate:
-        await user.generate(context, uuid, provider)
+        await user.generate(context, story, provider)
     else:
         if context[-1] != '\n':
             context += '\n'
-        story.action(context, STORY_TEXTTYPE_USER)
+        story.action(context, STORY_TEXTTYPE_USER, await worker_pool.run(count_entry_tokens, context))
         await story.save()
 
 # !undo
+@command
 async def cmd_story_undo(id: int=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -158,6 +219,7 @@ async def cmd_story_undo(id: int=None):
     await story.save()
 
 # !retry
+@command
 async def cmd_story_retry(id: int=None, provider: ModelProvider=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -168,9 +230,10 @@ async def cmd_story_retry(id: int=None, provider: ModelProvider=None):
     story = await get_story(uuid)
     story.undo()
     await story.save()
-    await user.generate(None, uuid, provider)
+    await user.generate(None, story, provider)
 
 # !alter
+@command
 async def cmd_story_alter(id: int=None, new_text: str=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -180,10 +243,12 @@ async def cmd_story_alter(id: int=None, new_text: str=None):
         raise ValueError('story does not exist')
     story = await get_story(uuid)
     story.undo()
-    story.action('\n'+new_text, STORY_TEXTTYPE_ALTERED)
+    new_text = '\n' + new_text
+    story.action(new_text, STORY_TEXTTYPE_ALTERED, await worker_pool.run(count_entry_tokens, new_text))
     await story.save()
 
 # !memory
+@command
 async def cmd_story_memory(id: int=None, memory: str=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -191,12 +256,11 @@ async def cmd_story_memory(id: int=None, memory: str=None):
     user = await get_user(id)
     if uuid not in user.storyids:
         raise ValueError('story does not exist')
-    story = await get_story(uuid)
     if memory is not None:
-        story.content_metadata.memory = memory
-    await story.save()
+        return await update_story_metadata(uuid, memory=memory)
 
 # !authorsnote
+@command
 async def cmd_story_authorsnote(id: int=None, note: str=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -204,12 +268,41 @@ async def cmd_story_authorsnote(id: int=None, note: str=None):
     user = await get_user(id)
     if uuid not in user.storyids:
         raise ValueError('story does not exist')
-    story = await get_story(uuid)
     if note is not None:
-        story.content_metadata.authorsNote = f'[ A/N: {note} ]'
+        return await update_story_metadata(uuid, authorsNote=f'[ A/N: {note} ]')
+
+# !stickyturns
+@command
+async def cmd_story_stickyturns(id: int=None, turns: int=None):
+    if id not in current_stories:
+        raise ValueError('A story must be selected using !selectstory')
+    uuid = current_stories[id]
+    user = await get_user(id)
+    if uuid not in user.storyids:
+        raise ValueError('story does not exist')
+    if (turns is None) or (turns < 0):
+        raise ValueError('turns must be 0 or more')
+    story = await get_story(uuid)
+    story.content.activation.sticky_turns = turns
+    await story.save()
+
+# !retrieval
+@command
+async def cmd_story_retrieval(id: int=None, enabled: bool=None):
+    if id not in current_stories:
+        raise ValueError('A story must be selected using !selectstory')
+    uuid = current_stories[id]
+    user = await get_user(id)
+    if uuid not in user.storyids:
+        raise ValueError('story does not exist')
+    if enabled is None:
+        raise ValueError('enabled is required')
+    story = await get_story(uuid)
+    story.content.activation.retrieval = enabled
     await story.save()
 
 # !add
+@command
 async def cmd_story_add(id: int=None, added_text: str=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -221,10 +314,12 @@ async def cmd_story_add(id: int=None, added_text: str=None):
     story.undo()
     # add a newline if the last character isn't a newline
     prefix = '\n' if story.content.entries[-1][0][-1] != '\n' else ''
-    story.action(f'{prefix+added_text}\n', STORY_TEXTTYPE_USER)
+    added_text = f'{prefix+added_text}\n'
+    story.action(added_text, STORY_TEXTTYPE_USER, await worker_pool.run(count_entry_tokens, added_text))
     await story.save()
 
 # !edit
+@command
 async def cmd_story_edit(id: int=None, new_title: str=None, new_description: str=None, new_author: str=None, new_genre: str=None, new_tags: str=None, new_style: str=None):
     if id not in current_stories:
         raise ValueError('A story must be selected using !selectstory')
@@ -232,18 +327,12 @@ async def cmd_story_edit(id: int=None, new_title: str=None, new_description: str
     user = await get_user(id)
     if uuid not in user.storyids:
         raise ValueError('story does not exist')
-    story = await get_story(uuid)
-    story.undo()
-    if new_title is not None:
-        story.content_metadata.title = new_title
-    if new_description is not None:
-        story.content_metadata.description = new_description
-    if new_author is not None:
-        story.content_metadata.author = new_author
-    if new_genre is not None:
-        story.content_metadata.genre = new_genre
-    if new_tags is not None:
-        story.content_metadata.tags = new_tags
-    if new_style is not None:
-        story.content_metadata.style = new_style
-    await story.save()
+    fields = {
+        'title': new_title,
+        'description': new_description,
+        'author': new_author,
+        'genre': new_genre,
+        'tags': new_tags,
+        'style': new_style
+    }
+    await update_story_metadata(uuid, **{k: v for k, v in fields.items() if v is not None})
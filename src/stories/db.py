@@ -1,21 +1,116 @@
-from typing import Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+from sqlalchemy import event
 import src.db.crud.user as user
-from src.db.schemas.user import User, Story
+from src.db.schemas.user import User, Story, StoryAction, StorySummary
 from src.db.database import async_session
+from src.stories.codec import encode_content
 
-async def user_create(id: int, gensettings: str, storyids: str, quota: int) -> Optional[User]:
-    async with async_session() as session, session.begin():
-        return await user.user.create_user(
-            session=session,
-            id=id,
-            gensettings=gensettings,
-            storyids=storyids,
-            quota=quota
-        )
+# the database work of one command: one session, an identity map and the saves written
+# right before its single commit
+class UnitOfWork:
+    def __init__(self, session):
+        self.session = session
+        self.objects = {} # ('user', id) or ('story', uuid) -> loaded object
+        self.dirty = {} # same keys -> object to save when the command finishes
+        self.committed = [] # callbacks run after the commit
+        self.rolled_back = [] # callbacks run after a rollback
+        self.finished = [] # callbacks run last either way
+        self.locked = set() # keys of the objects locked for the unit
+        self.wrote = False # whether the open transaction holds writes
+        event.listen(session.sync_session, 'do_orm_execute', self.on_execute)
+        event.listen(session.sync_session, 'after_flush', self.on_flush)
+        event.listen(session.sync_session, 'after_commit', self.on_commit)
+
+    def on_execute(self, state):
+        if state.is_insert or state.is_update or state.is_delete:
+            self.wrote = True
+
+    def on_flush(self, session, flush_context):
+        self.wrote = True
+
+    def on_commit(self, session):
+        self.wrote = False
+
+    # whether the session has nothing to write, neither written in its open transaction
+    # nor pending in the identity map
+    def read_only(self):
+        session = self.session
+        return not (self.wrote or session.new or session.dirty or session.deleted)
 
-async def user_update(id: int, gensettings: str, storyids: str, quota: int) -> Optional[User]:
+    def get(self, key):
+        return self.objects.get(key)
+
+    def add(self, key, obj):
+        self.objects[key] = obj
+
+    # saving the same object twice in one command writes it once
+    def defer(self, key, obj):
+        self.dirty[key] = obj
+
+    def forget(self, key):
+        self.objects.pop(key, None)
+        self.dirty.pop(key, None)
+
+    async def flush(self):
+        while len(self.dirty) > 0:
+            key = next(iter(self.dirty))
+            await self.dirty.pop(key).flush()
+
+current_work = ContextVar('current_work', default=None)
+
+# runs the body as one unit of work, or as part of the unit already running
+@asynccontextmanager
+async def unit_of_work():
+    work = current_work.get()
+    if work is not None:
+        yield work
+        return
+    async with async_session() as session:
+        work = UnitOfWork(session)
+        token = current_work.set(work)
+        try:
+            try:
+                yield work
+                await work.flush()
+                await session.commit()
+            except BaseException:
+                await session.rollback()
+                for callback in work.rolled_back:
+                    callback()
+                raise
+            finally:
+                current_work.reset(token)
+            for callback in work.committed:
+                callback()
+        finally:
+            for callback in work.finished:
+                callback()
+
+# the session of the running unit of work, or a new one committed on exit
+@asynccontextmanager
+async def session_scope():
+    work = current_work.get()
+    if work is not None:
+        yield work.session
+        return
     async with async_session() as session, session.begin():
-        return await user.user.update_user(
+        yield session
+
+# ends the open transaction of the unit of work before a long wait, like a generation
+# request, so its connection goes back to the pool instead of idling in a transaction.
+# only a transaction without writes is ended, committing one with writes would make them
+# durable even if the command fails later. deferred saves are untouched, the next query
+# takes a connection again
+async def release_connection():
+    work = current_work.get()
+    if work is not None and work.session.in_transaction() and work.read_only():
+        await work.session.commit()
+
+async def user_upsert(id: int, gensettings: str, storyids: str, quota: int) -> None:
+    async with session_scope() as session:
+        return await user.user.upsert_user(
             session=session,
             id=id,
             gensettings=gensettings,
@@ -24,47 +119,84 @@ async def user_update(id: int, gensettings: str, storyids: str, quota: int) -> O
         )
 
 async def user_delete(id: int) -> Optional[User]:
-    async with async_session() as session, session.begin():
+    async with session_scope() as session:
         return await user.user.delete_user(
             session=session,
             id=id
         )
 
 async def user_get(id: int) -> Optional[User]:
-    async with async_session() as session, session.begin():
+    async with session_scope() as session:
         return await user.user.get_by_ids(
             session=session,
             id=id
         )
 
-async def story_create(uuid: str, owner_id: int, content_metadata: str, content: str) -> Optional[Story]:
-    async with async_session() as session, session.begin():
-        return await user.story.create_story(
+# content is passed as JSON text, encoded by content_codec in a worker before the session
+# is used
+async def story_upsert(uuid: str, owner_id: int, content_metadata: dict, content: str, activation: str) -> None:
+    content = await encode_content(content)
+    async with session_scope() as session:
+        return await user.story.upsert_story(
             session=session,
             uuid=uuid,
             owner_id=owner_id,
             content_metadata=content_metadata,
-            content=content
+            content=content,
+            activation=activation
         )
 
-async def story_update(uuid: str, content_metadata: str, content: str) -> Optional[Story]:
-    async with async_session() as session, session.begin():
-        return await user.story.update_story(
+async def story_update_metadata(uuid: str, fields: dict) -> Optional[dict]:
+    async with session_scope() as session:
+        return await user.story.update_metadata(
+            session=session,
+            uuid=uuid,
+            fields=fields
+        )
+
+async def story_get_metadata(uuid: str) -> Optional[dict]:
+    async with session_scope() as session:
+        return await user.story.get_metadata(
+            session=session,
+            uuid=uuid
+        )
+
+async def story_append_actions(uuid: str, content_metadata: Optional[dict], activation: str, start: int, actions: list, length: int, truncate: bool) -> None:
+    async with session_scope() as session:
+        return await user.story.append_actions(
             session=session,
             uuid=uuid,
             content_metadata=content_metadata,
-            content=content
+            activation=activation,
+            start=start,
+            actions=actions,
+            length=length,
+            truncate=truncate
+        )
+
+async def story_list(owner_id: int) -> List[StorySummary]:
+    async with session_scope() as session:
+        return await user.story.list_by_owner(
+            session=session,
+            owner_id=owner_id
+        )
+
+async def story_get_actions(uuid: str) -> List[StoryAction]:
+    async with session_scope() as session:
+        return await user.story.get_actions(
+            session=session,
+            uuid=uuid
         )
 
 async def story_delete(uuid: str) -> Optional[Story]:
-    async with async_session() as session, session.begin():
+    async with session_scope() as session:
         return await user.story.delete_story(
             session=session,
             uuid=uuid
         )
 
 async def story_get(uuid: str) -> Optional[Story]:
-    async with async_session() as session, session.begin():
+    async with session_scope() as session:
         return await user.story.get_by_ids(
             session=session,
             uuid=uuid
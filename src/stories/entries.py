@@ -0,0 +1,103 @@
+from array import array
+from itertools import accumulate
+
+# story entries packed into columns, the UTF-8 text in one buffer with offsets and text types
+# in arrays. reads as a sequence of (text, texttype) tuples
+class StoryEntries:
+    def __init__(self, entries=()):
+        self.buffer = bytearray()
+        self.offsets = array('Q', [0]) # byte offset of every entry, plus the end of the buffer
+        self.char_offsets = array('Q', [0]) # same in characters
+        self.types = array('B')
+        entries = list(entries)
+        if len(entries) > 0:
+            self.load(''.join(text for text, _ in entries), [len(text) for text, _ in entries], [texttype for _, texttype in entries])
+
+    # fills empty columns from the whole text, the length in characters and the type of
+    # every entry, so loading a long story appends nothing one by one
+    def load(self, text, lengths, types):
+        self.buffer = bytearray(text.encode('utf-8'))
+        self.char_offsets = array('Q', [0, *accumulate(lengths)])
+        if len(self.buffer) == len(text):
+            # ascii only, bytes and characters line up
+            self.offsets = array('Q', self.char_offsets)
+        else:
+            offsets = self.char_offsets
+            self.offsets = array('Q', [0, *accumulate(len(text[offsets[i]:offsets[i + 1]].encode('utf-8')) for i in range(len(lengths)))])
+        self.types = array('B', types)
+
+    # the stored form: the whole text as one string, with entry lengths and types alongside
+    def columns(self):
+        offsets = self.char_offsets
+        return {
+            'text': self.text(),
+            'lengths': [offsets[i + 1] - offsets[i] for i in range(len(self))],
+            'types': self.types.tolist()
+        }
+
+    # lets pydantic models use StoryEntries as a field type, validating either the stored
+    # columns or a list of (text, texttype) entries
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v):
+        if isinstance(v, cls):
+            return v
+        if isinstance(v, dict):
+            entries = cls()
+            entries.load(v['text'], v['lengths'], v['types'])
+            return entries
+        return cls(v)
+
+    def append(self, entry):
+        text, texttype = entry
+        self.buffer += text.encode('utf-8')
+        self.offsets.append(len(self.buffer))
+        self.char_offsets.append(self.char_offsets[-1] + len(text))
+        self.types.append(texttype)
+
+    def pop(self):
+        entry = self[-1]
+        del self.buffer[self.offsets[-2]:]
+        self.offsets.pop()
+        self.char_offsets.pop()
+        self.types.pop()
+        return entry
+
+    # text of the entries from start up to stop joined together, decoded in one go
+    def text(self, start=0, stop=None):
+        if stop is None:
+            stop = len(self)
+        with memoryview(self.buffer) as view:
+            with view[self.offsets[start]:self.offsets[stop]] as part:
+                return str(part, 'utf-8')
+
+    # number of characters in the entries from start on
+    def char_length(self, start=0):
+        return self.char_offsets[-1] - self.char_offsets[start]
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if (idx < 0) or (idx >= len(self)):
+            raise IndexError('story entry index out of range')
+        return self.text(idx, idx + 1), self.types[idx]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __eq__(self, other):
+        if isinstance(other, StoryEntries):
+            return (self.buffer == other.buffer) and (self.offsets == other.offsets) and (self.types == other.types)
+        return list(self) == [tuple(i) for i in other]
+
+    def __repr__(self):
+        return f'<StoryEntries entries={len(self)} bytes={len(self.buffer)}>'
@@ -0,0 +1,73 @@
+import re
+from collections import Counter
+import numpy as np
+
+term_pattern = re.compile(r'\w+')
+
+def terms(text):
+    return term_pattern.findall(text.lower())
+
+# okapi BM25 over a fixed set of documents, with the weight of every (term, document) pair
+# precomputed in a term-major sparse matrix
+class BM25Index:
+    def __init__(self, documents, k1=1.2, b=0.75):
+        self.num_docs = len(documents)
+        self.vocab = {} # term -> term id
+
+        term_ids, doc_ids, freqs = [], [], []
+        lengths = np.zeros(self.num_docs, dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            counts = {}
+            for term in terms(document):
+                counts[term] = counts.get(term, 0) + 1
+            lengths[doc_id] = sum(counts.values())
+            for term, freq in counts.items():
+                term_ids.append(self.vocab.setdefault(term, len(self.vocab)))
+                doc_ids.append(doc_id)
+                freqs.append(freq)
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        freqs = np.array(freqs, dtype=np.float32)
+        order = np.argsort(term_ids, kind='stable')
+        term_ids, doc_ids, freqs = term_ids[order], doc_ids[order], freqs[order]
+
+        # postings of term t are doc_ids[indptr[t]:indptr[t + 1]]
+        self.indptr = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.vocab)), out=self.indptr[1:])
+
+        doc_freqs = np.diff(self.indptr).astype(np.float32)
+        idf = np.log1p((self.num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        avg_length = max(float(lengths.mean()), 1.0) if self.num_docs > 0 else 1.0
+        norm = k1 * (1.0 - b + b * lengths[doc_ids] / avg_length)
+        self.doc_ids = doc_ids.astype(np.int32)
+        self.weights = (idf[term_ids] * freqs * (k1 + 1.0) / (freqs + norm)).astype(np.float32)
+
+    # returns the BM25 score of every document for query
+    def score(self, query):
+        counts = {}
+        for term, freq in Counter(terms(query)).items():
+            term_id = self.vocab.get(term)
+            if term_id is not None:
+                counts[term_id] = freq
+        if len(counts) == 0:
+            return np.zeros(self.num_docs, dtype=np.float32)
+
+        query_terms = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        query_freqs = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        starts = self.indptr[query_terms]
+        lengths = self.indptr[query_terms + 1] - starts
+        # positions of every posting of every query term, without a python loop
+        postings = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        weights = self.weights[postings] * np.repeat(query_freqs, lengths)
+        return np.bincount(self.doc_ids[postings], weights=weights, minlength=self.num_docs)
+
+    # returns the ids of the k best scoring documents that match query at all, best first
+    def top_k(self, query, k):
+        if k <= 0:
+            return []
+        scores = self.score(query)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind='stable')].tolist()
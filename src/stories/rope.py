@@ -0,0 +1,98 @@
+import random
+from bisect import bisect_right
+
+# a segment of the assembled text with the sorted offsets where each kind of unit ends
+class Piece:
+    def __init__(self, text, boundaries):
+        self.text = text
+        self.boundaries = boundaries
+
+    # splits the piece after its n-th boundary of kind, 0 < n < number of those boundaries
+    def split(self, kind, n):
+        offset = self.boundaries[kind][n - 1]
+        left = []
+        right = []
+        for boundaries in self.boundaries:
+            idx = bisect_right(boundaries, offset)
+            left.append(boundaries[:idx])
+            right.append([i - offset for i in boundaries[idx:]])
+        return Piece(self.text[:offset], tuple(left)), Piece(self.text[offset:], tuple(right))
+
+class RopeNode:
+    def __init__(self, piece):
+        self.piece = piece
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.counts = tuple(len(i) for i in piece.boundaries) # boundaries in this subtree
+
+    def update(self):
+        counts = [len(i) for i in self.piece.boundaries]
+        for child in (self.left, self.right):
+            if child is not None:
+                for kind, count in enumerate(child.counts):
+                    counts[kind] += count
+        self.counts = tuple(counts)
+
+# pieces in a treap ordered by position, inserting after the n-th unit boundary is O(log n)
+class Rope:
+    def __init__(self):
+        self.root = None
+
+    def count(self, kind):
+        return self.root.counts[kind] if self.root is not None else 0
+
+    # inserts piece right after the position-th boundary of kind, 0 inserts at the start
+    def insert(self, kind, position, piece):
+        left, right = self.split(self.root, kind, position)
+        self.root = self.merge(self.merge(left, RopeNode(piece)), right)
+
+    # returns (head, tail) where head holds the first n boundaries of kind
+    def split(self, node, kind, n):
+        if node is None:
+            return None, None
+        left_count = node.left.counts[kind] if node.left is not None else 0
+        if n <= left_count:
+            head, tail = self.split(node.left, kind, n)
+            node.left = tail
+            node.update()
+            return head, node
+        n -= left_count
+        own_count = len(node.piece.boundaries[kind])
+        if n >= own_count:
+            head, tail = self.split(node.right, kind, n - own_count)
+            node.right = head
+            node.update()
+            return node, tail
+        # the position falls inside this piece
+        node.piece, rest = node.piece.split(kind, n)
+        tail = self.merge(RopeNode(rest), node.right)
+        node.right = None
+        node.update()
+        return node, tail
+
+    def merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.merge(left.right, right)
+            left.update()
+            return left
+        right.left = self.merge(left, right.left)
+        right.update()
+        return right
+
+    def text(self):
+        pieces = []
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            pieces.append(node.piece.text)
+            node = node.right
+        return ''.join(pieces)
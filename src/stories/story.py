@@ -1,26 +1,39 @@
 from typing import Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+import itertools
 import json
+from datetime import datetime, timezone
 import uuid
+from collections import OrderedDict
 
-from src.stories.db import (
-    user_create, user_update, user_delete, user_get,
-    story_create, story_update, story_delete, story_get
-)
-from src.stories.api import ModelProvider, ModelGenRequest
-from src.stories.context import ContextEntry, ContextManager, Lorebook
+from src.stories.db import story_delete, story_get, story_upsert, story_append_actions, story_get_actions, story_list, current_work
+from src.stories.context import ContextEntry, ContextManager, get_lorebook, lorebooks
+from src.stories.cache import forget_object, save_object
+from src.stories.codec import decode_content
+from src.stories.entries import StoryEntries
+from src.stories.tokenizer import tokenizer_service
+from src.stories.workers import worker_pool
 from src.stories.context import (
     TRIM_DIR_BOTTOM, TRIM_DIR_NONE, TRIM_DIR_TOP,
     TRIM_TYPE_NEWLINE, TRIM_TYPE_SENTENCE, TRIM_TYPE_TOKEN,
     INSERTION_TYPE_NEWLINE, INSERTION_TYPE_SENTENCE, INSERTION_TYPE_TOKEN,
-    tokenizer
+    ACTIVATION_MODE_KEYS, ACTIVATION_MODE_RETRIEVAL
 )
 
 STORY_TEXTTYPE_USER = 0
 STORY_TEXTTYPE_AI = 1
 STORY_TEXTTYPE_ALTERED = 2
 
+LOREBOOK_PATH = './lorebooks/touhou.lorebook'
+
+# the action log is folded into a new snapshot once it holds as many characters as the
+# snapshot, so every character is rewritten a bounded number of times
+COMPACTION_MIN_CHARS = 16384
+
+# activations remembered for undo, older ones are searched again from scratch
+ACTIVATION_HISTORY = 16
+
 class StoryMetadataV1(BaseModel):
     version: int = 1
     title: str = 'New Story'
@@ -34,12 +47,141 @@ class StoryMetadataV1(BaseModel):
     lorebook: str = None
     contextPreamble: bool = True
 
+class StoryActivationV1(BaseModel):
+    version: int = 1
+    lorebook: Optional[str] = None # lorebook the state was built against
+    scan_offset: int = 0 # number of story characters already searched for keys
+    sticky_turns: int = 0 # number of turns an entry stays active after it stops matching
+    retrieval: bool = False # rank lorebook entries against the story with BM25 instead of matching keys
+    matches: dict = {} # entry id -> story offset of the entry's last key match
+    turns: dict = {} # entry id -> last turn (number of story actions) the entry was active
+    history: list = [] # [turn, scan_offset, matches, turns] after each of the last activations, oldest first
+
 class StoryContentV1(BaseModel):
     version: int = 1
     entries: list = []
+    activation: StoryActivationV1 = StoryActivationV1()
+
+class StoryContentV2(BaseModel):
+    version: int = 2
+    entries: list = []
+    token_counts: list = [] # token count of every entry, None until it is counted
+    activation: StoryActivationV1 = StoryActivationV1()
+
+class StoryContentV3(BaseModel):
+    version: int = 3
+    entries: StoryEntries = Field(default_factory=StoryEntries) # stored as columns, see StoryEntries.columns
+    token_counts: list = [] # token count of every entry, None until it is counted
+    activation: StoryActivationV1 = StoryActivationV1()
+
+    class Config:
+        json_encoders = {StoryEntries: StoryEntries.columns}
+
+# what listing a user's stories shows, without loading their content
+class StorySummary(BaseModel):
+    story_uuid: str
+    content_metadata: StoryMetadataV1
+    content_bytes: int = 0 # approximate size, the stored content and actions when listed from the database
+    actions: int = 0 # entries stored after the snapshot
+    updated_at: Optional[datetime] = None
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            story_uuid=row.uuid,
+            content_metadata=parse_metadata(row.content_metadata),
+            content_bytes=row.content_bytes or 0,
+            actions=row.actions,
+            updated_at=row.updated_at
+        )
+
+# summaries of every stored story of an owner by uuid, from a single query
+async def stored_summaries(owner_id):
+    return {row.uuid: StorySummary.from_row(row) for row in await story_list(owner_id)}
+
+# stored metadata is a JSONB object, rows written before it was may still hold JSON text
+def parse_metadata(content_metadata):
+    if isinstance(content_metadata, str):
+        content_metadata = json.loads(content_metadata)
+    return StoryMetadataV1(**content_metadata)
+
+# parses stored story content, migrating older versions. token counts of version 1 stories
+# are filled in by Story.count_tokens the first time they are needed
+def parse_content(content: dict):
+    version = content.get('version', 1)
+    if version == 1:
+        content = StoryContentV1(**content)
+        return StoryContentV3(
+            entries=content.entries,
+            token_counts=[None] * len(content.entries),
+            activation=content.activation
+        )
+    if version == 2:
+        content = StoryContentV2(**content)
+        return StoryContentV3(
+            entries=content.entries,
+            token_counts=content.token_counts,
+            activation=content.activation
+        )
+    return StoryContentV3(**content)
+
+# LRU cache of context key -> (prompt, activation state), bounded by the length of the
+# prompts. cached values must not be mutated
+class ContextCache:
+    def __init__(self, max_chars=8*1024*1024):
+        self.max_chars = max_chars
+        self.num_chars = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        cached = self.entries.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return cached
+
+    def put(self, key, prompt, activation):
+        if (key in self.entries) or (len(prompt) > self.max_chars):
+            return
+        self.entries[key] = (prompt, activation)
+        self.num_chars += len(prompt)
+        while self.num_chars > self.max_chars:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.num_chars -= len(evicted)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.num_chars = 0
+
+context_cache = ContextCache()
+
+# the state of a story when a unit of work started using it, the number of entries and the
+# entries undone below it instead of a copy
+class StoryCheckpoint:
+    def __init__(self, story):
+        self.length = len(story.content.entries)
+        self.low = self.length # fewest entries the story had since
+        self.undone = [] # (entry, token count) undone below low, the last one first
+        self.revisions = list(story.revisions)
+        self.base_revision = story.base_revision
+        self.metadata_revision = story.metadata_revision
+        self.content_metadata = story.content_metadata.copy()
+        self.activation = story.content.activation.copy(deep=True)
+
+# revisions are unique within the process, so a revision identifies a story's state without
+# looking at its text
+revisions = itertools.count(1)
 
 class Story:
-    def __init__(self, story_uuid: str = None, owner_id: int=None, content_metadata: StoryMetadataV1=None, content: StoryContentV1=None):
+    def __init__(self, story_uuid: str = None, owner_id: int=None, content_metadata: StoryMetadataV1=None, content: StoryContentV3=None):
         if story_uuid is None:
             story_uuid = str(uuid.uuid4())
         if owner_id is None:
@@ -53,25 +195,156 @@ class Story:
                 contextPreamble=True
             )
         if content is None:
-            content = StoryContentV1()
+            content = StoryContentV3()
         
         self.story_uuid = story_uuid
         self.owner_id = owner_id
         self.content_metadata = content_metadata
         self.content = content
+        self.snapshot_length = 0 # entries stored in the content snapshot, the rest are actions
+        self.synced = 0 # leading entries known to be stored unchanged
+        self.stored = False # whether the story row exists, known from load or save
+        self.stored_length = 0 # entries stored, snapshot and actions together
+        self.metadata_changed = False # whether the metadata needs writing on the next flush
+        self.base_revision = next(revisions) # revision of the entries loaded or created with the story
+        self.revisions = [] # revision after each entry appended since, undo pops them
+        self.metadata_revision = next(revisions)
+        self.saved_state = None # StoryCheckpoint of the running unit of work
 
-    def action(self, text, aitext=STORY_TEXTTYPE_USER):
+    # token_count comes from count_entry_tokens run in a worker. without it the count is left
+    # to count_tokens, which runs with the context build in a worker
+    def action(self, text, aitext=STORY_TEXTTYPE_USER, token_count=None):
         self.content.entries.append((text, aitext))
+        self.content.token_counts.append(token_count)
+        self.revisions.append(next(revisions))
     
     def undo(self):
         if len(self.content.entries) > 0:
+            state = self.saved_state
+            if (state is not None) and (len(self.content.entries) <= state.low):
+                counts = self.content.token_counts
+                idx = len(self.content.entries) - 1
+                state.undone.append((self.content.entries[idx], counts[idx] if idx < len(counts) else None))
+                state.low = idx
             self.content.entries.pop()
+            del self.content.token_counts[len(self.content.entries):]
+            if len(self.revisions) > 0:
+                self.revisions.pop()
+            self.synced = min(self.synced, len(self.content.entries))
+            self.rewind_activation()
+
+    # matches may point into the removed text. goes back to the last activation made before
+    # it, which keeps the entries held by sticky_turns, or searches the story again without one
+    def rewind_activation(self):
+        state = self.content.activation
+        turn = len(self.content.entries)
+        history = [snapshot for snapshot in state.history if snapshot[0] <= turn]
+        if len(history) == 0:
+            self.content.activation = StoryActivationV1(sticky_turns=state.sticky_turns, retrieval=state.retrieval)
+            return
+        _, scan_offset, matches, turns = history[-1]
+        self.content.activation = StoryActivationV1(
+            lorebook=state.lorebook,
+            scan_offset=scan_offset,
+            sticky_turns=state.sticky_turns,
+            retrieval=state.retrieval,
+            matches=dict(matches),
+            turns=dict(turns),
+            history=history
+        )
     
+    # remembers the state to go back to if the running command fails
+    def checkpoint(self):
+        self.saved_state = StoryCheckpoint(self)
+
+    # goes back to the state of the checkpoint. what the failed command wrote was rolled
+    # back, so only entries below the fewest it left can still count as synced
+    def restore(self):
+        state = self.saved_state
+        if state is None:
+            return
+        entries = self.content.entries
+        counts = self.content.token_counts
+        while len(entries) > state.low:
+            entries.pop()
+        del counts[state.low:]
+        counts.extend([None] * (state.low - len(counts)))
+        for entry, count in reversed(state.undone):
+            entries.append(entry)
+            counts.append(count)
+        self.synced = min(self.synced, state.low)
+        self.revisions = state.revisions
+        self.base_revision = state.base_revision
+        self.metadata_revision = state.metadata_revision
+        self.content_metadata = state.content_metadata
+        self.content.activation = state.activation
+        self.saved_state = None
+
+    def release(self):
+        self.saved_state = None
+
+    # changes metadata fields, written with the next save without the content
+    def set_metadata(self, **fields):
+        for key, value in fields.items():
+            setattr(self.content_metadata, key, value)
+        self.metadata_changed = True
+        self.metadata_revision = next(revisions)
+
+    # whether the action log has grown enough to be folded into the snapshot
+    def needs_compaction(self):
+        entries = self.content.entries
+        if len(entries) < self.snapshot_length:
+            # an undo reached into the snapshot
+            return True
+        log_chars = entries.char_length(self.snapshot_length)
+        return log_chars >= max(entries.char_length() - log_chars, COMPACTION_MIN_CHARS)
+
+    # written behind through the object cache, or once when the unit of work finishes
     async def save(self):
-        if await story_get(self.story_uuid) is None:
-            await story_create(self.story_uuid, self.owner_id, self.content_metadata.json(), self.content.json())
-        else:
-            await story_update(self.story_uuid, self.content_metadata.json(), self.content.json())
+        await save_object(('story', self.story_uuid), self)
+
+    # stores new actions as rows of story_actions, rewriting the content only on compaction.
+    # every path is a single transaction without reading the story back first. the story
+    # may change while the write runs, only what was captured before it counts as synced
+    async def flush(self):
+        content = self.content
+        entries = content.entries
+        length = len(entries)
+        synced = self.synced
+        previous = (self.stored, self.stored_length, self.snapshot_length, self.metadata_changed)
+        content_metadata = self.content_metadata.dict()
+        # set ahead of the write, an undo or metadata change while it runs resets them
+        self.synced = length
+        self.metadata_changed = False
+        try:
+            if (not self.stored) or self.needs_compaction():
+                # a new story, or a compaction folding the actions into a new snapshot
+                await story_upsert(self.story_uuid, self.owner_id, content_metadata, content.json(), content.activation.json())
+                self.snapshot_length = length
+                self.stored = True
+            else:
+                counts = content.token_counts
+                actions = [
+                    (*entries[idx], counts[idx] if idx < len(counts) else None)
+                    for idx in range(synced, length)
+                ]
+                await story_append_actions(
+                    self.story_uuid, content_metadata if previous[3] else None, content.activation.json(),
+                    synced, actions, length, self.stored_length > length
+                )
+        except BaseException:
+            self.unsync(synced, previous)
+            raise
+        self.stored_length = length
+        work = current_work.get()
+        if work is not None:
+            # the write only counts once the unit of work commits
+            work.rolled_back.append(lambda: self.unsync(synced, previous))
+
+    def unsync(self, synced, previous):
+        self.synced = min(self.synced, synced)
+        self.stored, self.stored_length, self.snapshot_length, metadata_changed = previous
+        self.metadata_changed = self.metadata_changed or metadata_changed
     
     async def load(self, story_uuid: str):
         story = await story_get(story_uuid)
@@ -80,34 +353,85 @@ class Story:
         
         self.story_uuid = story_uuid
         self.owner_id = story.owner_id
-        self.content_metadata = StoryMetadataV1(**json.loads(story.content_metadata))
-        self.content = StoryContentV1(**json.loads(story.content))
+        self.content_metadata = parse_metadata(story.content_metadata)
+        self.content = parse_content(json.loads(await decode_content(story.content)))
+        self.snapshot_length = len(self.content.entries)
+        del self.content.token_counts[self.snapshot_length:]
+        self.content.token_counts.extend([None] * (self.snapshot_length - len(self.content.token_counts)))
+        for action in await story_get_actions(story_uuid):
+            self.content.entries.append((action.text, action.texttype))
+            self.content.token_counts.append(action.token_count)
+        if story.activation is not None:
+            self.content.activation = StoryActivationV1(**json.loads(story.activation))
+        self.synced = len(self.content.entries)
+        self.stored = True
+        self.stored_length = len(self.content.entries)
+        self.base_revision = next(revisions)
+        self.revisions = []
+        self.metadata_revision = next(revisions)
     
     async def delete(self):
+        await forget_object(('story', self.story_uuid))
         await story_delete(self.story_uuid)
 
-    def raw_txt(self, format=False, highlight_lastline=False, char_limit=256):
-        story_str = ''
+    # summary of a story whose latest changes are not stored yet
+    def summary(self):
+        return StorySummary(
+            story_uuid=self.story_uuid,
+            content_metadata=self.content_metadata,
+            content_bytes=len(self.content.entries.buffer),
+            actions=len(self.content.entries) - self.snapshot_length,
+            updated_at=datetime.now(timezone.utc)
+        )
+
+    # approximate memory held by the story in bytes, for the object cache. every entry
+    # also costs its offsets, type and token count besides its text
+    def size(self):
+        entries = self.content.entries
+        return len(entries.buffer) + 64 * len(entries) + 4096
 
-        for i, v in enumerate(self.content.entries):
+    # renders entry i the way raw_txt shows it
+    def render_entry(self, i, format=False, highlight_lastline=False):
+        v = self.content.entries[i]
+        if highlight_lastline:
             # check if v is the last entry
-            if highlight_lastline:
-                format = False
-                if i == len(self.content.entries) - 1:
-                    story_str += f'**{v[0]}**'
-                    break
-                else:
-                    story_str += f'{v[0]}'
-                continue
-            if format:
-                # bolden user text
-                if v[1] == STORY_TEXTTYPE_USER:
-                    story_str += f'**``{v[0]}``**'
-                else:
-                    story_str += f'``{v[0]}``'
-            else:
-                # raw text
-                story_str += v[0]
+            if i == len(self.content.entries) - 1:
+                return f'**{v[0]}**'
+            return v[0]
+        if format:
+            # bolden user text
+            if v[1] == STORY_TEXTTYPE_USER:
+                return f'**``{v[0]}``**'
+            return f'``{v[0]}``'
+        # raw text
+        return v[0]
+
+    # yields the rendered story entry by entry, so the full text is never built in memory
+    def iter_txt(self, format=False, highlight_lastline=False):
+        for i in range(len(self.content.entries)):
+            yield self.render_entry(i, format, highlight_lastline)
+
+    def txt_length(self):
+        return self.content.entries.char_length()
+
+    def raw_txt(self, format=False, highlight_lastline=False, char_limit=256):
+        if highlight_lastline and (len(self.content.entries) > 0):
+            format = False
+
+        if (char_limit is None) or (char_limit <= 0):
+            story_str = ''.join(self.iter_txt(format, highlight_lastline))
+        else:
+            # render from the last entry back until more than char_limit characters are
+            # rendered, so previews only pay for the text they show
+            pieces = []
+            length = 0
+            i = len(self.content.entries) - 1
+            while (i >= 0) and (length <= char_limit):
+                pieces.append(self.render_entry(i, format, highlight_lastline))
+                length += len(pieces[-1])
+                i -= 1
+            story_str = ''.join(reversed(pieces))
+
         # trim to char limit if it is not None
         if char_limit is not None:
             if len(story_str) > char_limit:
@@ -118,10 +442,114 @@ class Story:
 
         return story_str
             
-    def context(self, max_tokens=2048): # generate context based on content
-        story_str = self.raw_txt(format=False, highlight_lastline=False, char_limit=None)
-        
-        contextmgr = ContextManager(max_tokens)
+    # returns the lorebook entries activated by the story text, only searching the text
+    # appended since the last call (plus enough overlap for keys crossing the boundary)
+    def activate(self, lorebook):
+        story_len = self.txt_length()
+        state = self.content.activation
+        index = lorebook.index
+        source = f'{lorebook.filepath}:{lorebook.mtime}'
+        if (state.lorebook != source) or (state.scan_offset > story_len):
+            state = StoryActivationV1(lorebook=source, sticky_turns=state.sticky_turns, retrieval=state.retrieval)
+            self.content.activation = state
+
+        if state.scan_offset == 0:
+            # nothing searched yet, only the widest search range can activate anything
+            start = 0
+            if index.max_search_range is not None:
+                start = max(story_len - index.max_search_range, 0)
+        else:
+            start = max(state.scan_offset - index.max_key_length + 1, 0)
+        tail = self.raw_txt(char_limit=story_len - start) if story_len > start else ''
+        for idx, position in index.last_matches(tail, start).items():
+            state.matches[index.entries[idx].id] = position
+        state.scan_offset = story_len
+
+        turn = len(self.content.entries)
+        activated = []
+        for entry_id, position in list(state.matches.items()):
+            entry = lorebook.ids.get(entry_id)
+            if entry is None:
+                del state.matches[entry_id]
+                continue
+            if (entry.search_range is None) or (position >= story_len - entry.search_range):
+                state.turns[entry_id] = turn
+            last_turn = state.turns.get(entry_id)
+            if (last_turn is None) or (turn - last_turn > state.sticky_turns):
+                # the match left the search range for good, the story only grows at the end
+                del state.matches[entry_id]
+                state.turns.pop(entry_id, None)
+                continue
+            activated.append(entry)
+
+        history = [snapshot for snapshot in state.history if snapshot[0] < turn]
+        history.append([turn, state.scan_offset, dict(state.matches), dict(state.turns)])
+        state.history = history[-ACTIVATION_HISTORY:]
+        return activated
+
+    # the revision of the entries, back to an earlier one after an undo. the revisions of
+    # loaded entries are told apart by their number
+    def revision(self):
+        if len(self.revisions) > 0:
+            return self.revisions[-1]
+        return (self.base_revision, len(self.content.entries))
+
+    # identifies everything a context depends on: the revisions of the entries and the
+    # metadata, the activation settings, the loaded lorebook and max_tokens. cheap enough
+    # for the event loop, nothing is hashed or read from disk. a lorebook edited on disk is
+    # noticed by the next build, a retry before it may reuse the earlier context
+    def context_key(self, max_tokens):
+        activation = self.content.activation
+        return (
+            self.revision(), self.metadata_revision, activation.sticky_turns, activation.retrieval,
+            lorebooks.version(LOREBOOK_PATH), max_tokens
+        )
+
+    # returns the context, built off the event loop, or the one built last time the story
+    # was in the same state, like before a retry
+    async def context(self, max_tokens=2048):
+        cached = context_cache.get(self.context_key(max_tokens))
+        if cached is None:
+            prompt, self.content = await worker_pool.run(build_context, self, max_tokens)
+            cached = (prompt, self.content.activation.copy(deep=True))
+            # building may have loaded the lorebook, which is part of the key
+            context_cache.put(self.context_key(max_tokens), *cached)
+        prompt, activation = cached
+        # an undo rewinds the activation state, restore the one the prompt came from
+        self.content.activation = activation.copy(deep=True)
+        return prompt
+
+    # counts the tokens of every entry that has not been counted yet, in one batch
+    def count_tokens(self):
+        counts = self.content.token_counts
+        del counts[len(self.content.entries):]
+        counts.extend([None] * (len(self.content.entries) - len(counts)))
+        missing = [idx for idx, count in enumerate(counts) if count is None]
+        if len(missing) == 0:
+            return
+        encodings = tokenizer_service.encode_batch([self.content.entries[idx][0] for idx in missing])
+        for idx, (ids, _) in zip(missing, encodings):
+            counts[idx] = len(ids)
+
+    # returns the shortest tail of the story, starting at an entry, with more than max_tokens
+    # tokens, so only text that can end up in the context gets tokenized
+    def tail_txt(self, max_tokens):
+        self.count_tokens()
+        start = len(self.content.entries)
+        num_tokens = 0
+        while (start > 0) and (num_tokens <= max_tokens):
+            start -= 1
+            num_tokens += self.content.token_counts[start]
+        # entries are counted on their own, one more entry covers tokens merging across them
+        start = max(start - 1, 0)
+        return self.content.entries.text(start)
+
+    def assemble_context(self, max_tokens=2048): # generate context based on content
+        # only the tail of the story is rendered, tokenized and trimmed
+        activation_mode = ACTIVATION_MODE_KEYS
+        if self.content.activation.retrieval:
+            activation_mode = ACTIVATION_MODE_RETRIEVAL
+        contextmgr = ContextManager(max_tokens, activation_mode=activation_mode)
 
         # Preamble Entry: Sets up the prompting for the initial story.
         if self.content_metadata.contextPreamble:
@@ -155,7 +583,7 @@ class Story:
 
         # Story Entry: Always included
         story_entry = ContextEntry(
-            text=story_str,
+            text=self.tail_txt(max_tokens),
             prefix='',
             suffix='',
             token_budget=2048,
@@ -166,7 +594,9 @@ class Story:
             trim_type=TRIM_TYPE_SENTENCE,
             insertion_type=INSERTION_TYPE_NEWLINE,
             forced_activation=True,
-            cascading_activation=True
+            # keyword activation is tracked incrementally by self.activate, retrieval ranks
+            # the lorebook against the story entry's text
+            cascading_activation=(activation_mode == ACTIVATION_MODE_RETRIEVAL)
         )
 
         memory_entry = ContextEntry(
@@ -199,21 +629,28 @@ class Story:
             cascading_activation=True
         )
 
-        lorebook = Lorebook('./lorebooks/touhou.lorebook')
-        #contextmgr.add_entries(lorebook.get_entries())
+        lorebook = get_lorebook(LOREBOOK_PATH)
+        contextmgr.add_lorebook(lorebook)
+        if activation_mode == ACTIVATION_MODE_KEYS:
+            contextmgr.activate_entries(self.activate(lorebook))
         contextmgr.add_entry(story_entry)
         contextmgr.add_entry(memory_entry)
         contextmgr.add_entry(authorsnote_entry)
         
         return contextmgr.context(max_tokens)
     
-    def generate(self, provider: ModelProvider, request: ModelGenRequest, max_tokens=2048):
-        request.prompt = self.context(max_tokens=max_tokens)
-        aitext = provider.generate(request)
-        self.action(aitext, STORY_TEXTTYPE_AI)
-
     def __repr__(self):
         return f'<Story {self.story_uuid}>'
 
     def __str__(self):
         return f'{self.story_uuid}'
+
+# the token count of an entry, run in a worker so stored actions carry their count
+def count_entry_tokens(text):
+    return len(tokenizer_service.encode(text))
+
+# builds the context of a story in a worker, returning the content along with it since a
+# process worker only updates its own copy of the story (activation state, token counts)
+def build_context(story: Story, max_tokens=2048):
+    context = story.assemble_context(max_tokens=max_tokens)
+    return context, story.content
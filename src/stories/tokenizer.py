@@ -0,0 +1,149 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from src.core.config import settings
+from src.core.logging import get_logger
+
+logger = get_logger(__name__)
+
+# the one place that encodes and decodes text. encodings are cached by text hash, bounded by
+# their number of tokens, misses are encoded in one batch. returned lists are shared and must
+# not be mutated
+class TokenizerService:
+    def __init__(self, name='gpt2', max_tokens=262144):
+        self.tokenizer_name = name
+        self.loaded = None # the fast tokenizer, once loaded
+        self.load_lock = threading.Lock()
+        self.warm_thread = None
+        self.cache_lock = threading.Lock() # worker threads share the cache
+        self.max_tokens = max_tokens # upper bound for the sum of cached token counts
+        self.num_tokens = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0 # calls made to the tokenizer
+
+    @property
+    def name(self):
+        return self.tokenizer_name
+
+    @property
+    def tokenizer(self):
+        if self.loaded is None:
+            self.load()
+        return self.loaded
+
+    # path of the vendored tokenizer file, a tokenizers library JSON file
+    def local_path(self):
+        return Path(settings.STORAGE_PATH) / 'tokenizers' / f'{self.tokenizer_name}.json'
+
+    def load(self):
+        with self.load_lock:
+            if self.loaded is not None:
+                return self.loaded
+            # transformers is only imported once a tokenizer is actually needed
+            from transformers import AutoTokenizer, PreTrainedTokenizerFast
+            start = time.perf_counter()
+            path = self.local_path()
+            if path.is_file():
+                self.loaded = PreTrainedTokenizerFast(tokenizer_file=str(path))
+                source = str(path)
+            else:
+                self.loaded = AutoTokenizer.from_pretrained(self.tokenizer_name)
+                source = 'the huggingface hub'
+                # vendor it so the next start works offline
+                try:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    self.loaded.backend_tokenizer.save(str(path))
+                except OSError as e:
+                    logger.warning(f'could not vendor tokenizer {self.tokenizer_name} to {path}: {e}')
+            logger.info(f'loaded tokenizer {self.tokenizer_name} from {source} in {time.perf_counter() - start:.2f}s')
+            return self.loaded
+
+    # loads the tokenizer in a background thread, if it is not loaded or loading already
+    def warm(self):
+        if (self.loaded is not None) or (self.warm_thread is not None and self.warm_thread.is_alive()):
+            return
+        self.warm_thread = threading.Thread(target=self.load, name='tokenizer-warmup', daemon=True)
+        self.warm_thread.start()
+
+    def key(self, text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    # encodes every text, returning token ids and the (start, end) character span of each token
+    def encode_batch(self, texts):
+        results = [None] * len(texts)
+        pending = OrderedDict() # key -> (text, indices of texts waiting for it)
+        with self.cache_lock:
+            for idx, text in enumerate(texts):
+                key = self.key(text)
+                cached = self.entries.get(key)
+                if cached is not None:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    results[idx] = cached
+                elif key in pending:
+                    self.hits += 1
+                    pending[key][1].append(idx)
+                else:
+                    self.misses += 1
+                    pending[key] = (text, [idx])
+            if len(pending) > 0:
+                self.batches += 1
+
+        if len(pending) > 0:
+            # the tokenizer runs outside the lock so other threads keep hitting the cache
+            encoding = self.tokenizer(
+                [text for text, _ in pending.values()],
+                return_offsets_mapping=True,
+                add_special_tokens=False
+            )
+            with self.cache_lock:
+                for (key, (_, indices)), ids, spans in zip(pending.items(), encoding['input_ids'], encoding['offset_mapping']):
+                    cached = (ids, spans)
+                    self.store(key, cached)
+                    for idx in indices:
+                        results[idx] = cached
+        return results
+
+    def encode_offsets(self, text):
+        return self.encode_batch([text])[0]
+
+    def encode(self, text):
+        return self.encode_offsets(text)[0]
+
+    def decode(self, ids):
+        return self.tokenizer.decode(ids)
+
+    # stores an encoding computed elsewhere, e.g. a precompiled lorebook
+    def put(self, text, ids, spans):
+        key = self.key(text)
+        with self.cache_lock:
+            self.store(key, (ids, spans))
+
+    # expects cache_lock to be held
+    def store(self, key, cached):
+        if (key in self.entries) or (len(cached[0]) > self.max_tokens):
+            # another thread may have encoded the same text meanwhile
+            return
+        self.entries[key] = cached
+        self.num_tokens += len(cached[0])
+        self.evict()
+
+    def evict(self):
+        while self.num_tokens > self.max_tokens:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_tokens -= len(evicted[0])
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def clear(self):
+        with self.cache_lock:
+            self.entries.clear()
+            self.num_tokens = 0
+
+tokenizer_service = TokenizerService(settings.TOKENIZER_NAME)
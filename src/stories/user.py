@@ -4,12 +4,19 @@ from pydantic import BaseModel, ValidationError, validator
 import json
 
 from src.stories.api import ModelGenArgs, ModelLogitBiasArgs, ModelPhraseBiasArgs, ModelProvider, ModelSampleArgs, ModelGenRequest, ModelSerializer
-from src.stories.db import (
-    user_create, user_update, user_delete, user_get,
-    story_create, story_update, story_delete, story_get
-)
-from src.stories.story import Story, STORY_TEXTTYPE_AI, STORY_TEXTTYPE_USER
+from src.stories.db import user_upsert, user_delete, user_get, story_delete, release_connection
+from src.stories.cache import forget_object, save_object, unwritten
+from src.stories.story import Story, STORY_TEXTTYPE_AI, STORY_TEXTTYPE_USER, count_entry_tokens, stored_summaries
 from src.stories.utils import cut_trailing_sentence
+from src.stories.workers import worker_pool
+
+# cuts the generated text after its last sentence and counts its tokens, in a worker
+def finish_output(text):
+    text = cut_trailing_sentence(text)
+    # check if text ends with a newline, if it doesn't, add one
+    if text[-1] != '\n':
+        text += '\n'
+    return text, count_entry_tokens(text)
 
 class UserSettingsV1(BaseModel):
     version: int = 1
@@ -52,40 +59,70 @@ class User:
         self.gensettings = gensettings
         self.storyids = storyids
         self.quota = quota
+        self.saved_state = None # (gensettings, storyids, quota) when the running unit of work started
 
+    # written behind through the object cache, or once when the unit of work finishes
     async def save(self):
-        if await user_get(self.client_id) is None:
-            await user_create(self.client_id, json.dumps(self.gensettings, cls=ModelSerializer), json.dumps(self.storyids, cls=ModelSerializer), self.quota)
-        else:
-            await user_update(self.client_id, json.dumps(self.gensettings, cls=ModelSerializer), json.dumps(self.storyids, cls=ModelSerializer), self.quota)
+        await save_object(('user', self.client_id), self)
+
+    async def flush(self):
+        await user_upsert(self.client_id, json.dumps(self.gensettings, cls=ModelSerializer), json.dumps(self.storyids, cls=ModelSerializer), self.quota)
     
     async def load(self, client_id: int):
         user = await user_get(client_id)
         if user is None:
             raise ValueError('user not found')
+        self.load_row(user)
 
-        self.client_id = client_id
-        if type(json.loads(user.gensettings)) == str:
-            user.gensettings = json.loads(user.gensettings)
-        self.gensettings = ModelGenRequest(**json.loads(user.gensettings))
+    # fills the user from its database row
+    def load_row(self, user):
+        self.client_id = user.id
+        # the row may belong to a live session, leave it unmodified
+        gensettings = user.gensettings
+        if type(json.loads(gensettings)) == str:
+            gensettings = json.loads(gensettings)
+        self.gensettings = ModelGenRequest(**json.loads(gensettings))
         self.storyids = json.loads(user.storyids)
         self.quota = user.quota
     
     async def delete(self):
         # delete stories
         for uuid in self.storyids:
+            await forget_object(('story', uuid))
             await story_delete(uuid)
         # delete user
+        await forget_object(('user', self.client_id))
         await user_delete(self.client_id)
 
-    async def get_stories(self):
-        stories = []
+    # remembers the state to go back to if the running command fails
+    def checkpoint(self):
+        self.saved_state = (self.gensettings.copy(deep=True), list(self.storyids), self.quota)
+
+    def restore(self):
+        if self.saved_state is not None:
+            self.gensettings, self.storyids, self.quota = self.saved_state
+            self.saved_state = None
+
+    def release(self):
+        self.saved_state = None
+
+    # approximate memory held by the user in bytes, for the object cache
+    def size(self):
+        return 4096 + 64 * len(self.storyids)
+
+    # summaries of the user's stories in the order of storyids, from a single query.
+    # stories with changes still waiting to be written are summarized from memory
+    async def list_stories(self):
+        stored = await stored_summaries(self.client_id)
+        summaries = []
         for story_uuid in self.storyids:
-            story = Story(story_uuid, id)
-            await story.load(story_uuid)
-            stories.append(story)
-        return stories
-    
+            story = unwritten(('story', story_uuid))
+            if story is not None:
+                summaries.append(story.summary())
+            elif story_uuid in stored:
+                summaries.append(stored[story_uuid])
+        return summaries
+
     async def create_story(self):
         story = Story(None, self.client_id, None, None)
         self.storyids.append(story.story_uuid)
@@ -95,32 +132,39 @@ class User:
     
     async def delete_story(self, uuid: str):
         self.storyids.remove(uuid)
+        await forget_object(('story', uuid))
         await story_delete(uuid)
         await self.save()
     
-    async def generate(self, context: str, uuid: str=None, provider: ModelProvider=None):
+    async def generate(self, context: str, story: Story=None, provider: ModelProvider=None):
         if self.quota == 0:
             raise ValueError('quota exceeded')
         # todo handle quota
 
-        story = Story(uuid, self.client_id)
-        await story.load(uuid)
         if story is None:
             raise ValueError('story not found')
         
-        if context is not None:
-            context = context.rstrip()
-            story.action(context, STORY_TEXTTYPE_USER)
-
-        r = self.gensettings
-        r.prompt = story.context(max_tokens=1024-r.gen_args.max_length)
-        r.sample_args.bad_words = [' Author', 'Author', 'Chapter', ' Chapter', '***']
-        aitext = cut_trailing_sentence(await provider.generate(r))
-        # check if aitext ends with a newline, if it doesn't, add one
-        if aitext[-1] != '\n':
-            aitext += '\n'
-        story.action(aitext, STORY_TEXTTYPE_AI)
-        await story.save()
+        # the story may be cached, a failure anywhere below leaves it as it was
+        length = len(story.content.entries)
+        activation = story.content.activation.copy(deep=True)
+        try:
+            if context is not None:
+                context = context.rstrip()
+                story.action(context, STORY_TEXTTYPE_USER)
+
+            r = self.gensettings
+            # building the context and cutting the output are kept off the event loop
+            r.prompt = await story.context(1024-r.gen_args.max_length)
+            r.sample_args.bad_words = [' Author', 'Author', 'Chapter', ' Chapter', '***']
+            await release_connection()
+            aitext, token_count = await worker_pool.run(finish_output, await provider.generate(r))
+            story.action(aitext, STORY_TEXTTYPE_AI, token_count)
+            await story.save()
+        except BaseException:
+            while len(story.content.entries) > length:
+                story.undo()
+            story.content.activation = activation
+            raise
 
         return story
     
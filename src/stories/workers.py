@@ -0,0 +1,81 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.core.config import settings
+from src.core.logging import get_logger
+from src.stories.tokenizer import tokenizer_service
+
+logger = get_logger(__name__)
+
+POOL_TYPE_THREAD='thread'
+POOL_TYPE_PROCESS='process'
+
+# runs in every worker before its first job
+def preload():
+    tokenizer_service.load()
+
+# runs a job inside a worker, timing it with the wall clock so process workers can be timed too
+def timed_call(fn, args):
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time()
+
+# runs CPU bound story work in a thread or process pool, off the event loop
+class WorkerPool:
+    def __init__(self, pool_type=POOL_TYPE_THREAD, max_workers=2):
+        if pool_type not in (POOL_TYPE_THREAD, POOL_TYPE_PROCESS):
+            raise ValueError(f'unknown pool type {pool_type}')
+        self.pool_type = pool_type
+        self.max_workers = max_workers
+        self.executor = None # created on the first job
+        self.in_flight = 0 # jobs submitted that have not finished
+        self.jobs = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.pool_type == POOL_TYPE_PROCESS:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=preload)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, initializer=preload, thread_name_prefix='story-worker')
+        return self.executor
+
+    # jobs waiting for a free worker
+    def queue_depth(self):
+        return max(self.in_flight - self.max_workers, 0)
+
+    # fn and its arguments must be picklable when running in a process pool
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        submitted = time.time()
+        self.in_flight += 1
+        depth = self.queue_depth()
+        try:
+            result, started, finished = await loop.run_in_executor(self.get_executor(), timed_call, fn, args)
+        finally:
+            self.in_flight -= 1
+        wait = max(started - submitted, 0.0)
+        self.jobs += 1
+        self.total_wait += wait
+        self.total_run += finished - started
+        logger.debug(f'{fn.__name__} ran in {finished - started:.3f}s after waiting {wait:.3f}s (queue depth {depth})')
+        return result
+
+    def stats(self):
+        return {
+            'pool_type': self.pool_type,
+            'max_workers': self.max_workers,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth(),
+            'jobs': self.jobs,
+            'avg_wait': self.total_wait / self.jobs if self.jobs > 0 else 0.0,
+            'avg_run': self.total_run / self.jobs if self.jobs > 0 else 0.0
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+worker_pool = WorkerPool(settings.WORKER_POOL_TYPE, settings.WORKER_POOL_SIZE)
@@ -0,0 +1,22 @@
+import os
+
+# settings the tests never use but that src.core.config requires
+for name, value in {
+    'PROJECT_NAME': 'test',
+    'POSTGRES_SERVER': 'localhost',
+    'POSTGRES_PORT': '5432',
+    'POSTGRES_USER': 'test',
+    'POSTGRES_PASSWORD': 'test',
+    'POSTGRES_DB': 'test',
+    'DISCORD_OWNER': '0',
+    'DISCORD_TOKEN': 'test',
+    'DISCORD_PREFIX': '!',
+    'DISCORD_PRIVACY_CHANNEL': '0',
+    'DISCORD_EMBED_COLOR': '0',
+    'CURRENT_STORY_CACHE': 'test'
+}.items():
+    os.environ.setdefault(name, value)
+
+# tests/test_db.py runs against a real database only when one is given
+if 'TEST_DATABASE_URI' in os.environ:
+    os.environ['DATABASE_URI'] = os.environ['TEST_DATABASE_URI']
@@ -0,0 +1,117 @@
+import random
+import pytest
+
+pytest.importorskip('transformers')
+
+from src.stories.context import (
+    TRIM_DIR_BOTTOM, TRIM_DIR_TOP, TRIM_TYPE_NEWLINE, TRIM_TYPE_SENTENCE, TRIM_TYPE_TOKEN, ContextEntry,
+    split_into_sentences, sentence_offsets, trim_newlines, trim_sentences
+)
+from src.stories.tokenizer import tokenizer_service
+
+# reference implementations: the line by line and sentence by sentence loops that encode
+# every candidate on its own. The sentence loop finds each sentence at its offset rather
+# than with rindex/index, which picked the wrong copy of a repeated sentence and counted
+# text_begin twice when trimming from the bottom.
+
+def reference_trim_newlines(tokens, trim_dir, limit):
+    if len(tokens) <= limit:
+        return tokens
+    lines = tokenizer_service.decode(tokens).split('\n')
+    if trim_dir == TRIM_DIR_TOP:
+        lines = ['\n' + line for line in reversed(lines)]
+    else:
+        lines = [line + '\n' for line in lines]
+    acc_tokens = []
+    for line in lines:
+        new_tokens = tokenizer_service.encode(line)
+        if len(new_tokens) + len(acc_tokens) > limit:
+            return acc_tokens
+        if trim_dir == TRIM_DIR_TOP:
+            acc_tokens = new_tokens + acc_tokens
+        else:
+            acc_tokens = acc_tokens + new_tokens
+    return acc_tokens
+
+def reference_trim_sentences(tokens, trim_dir, limit):
+    if len(tokens) <= limit:
+        return tokens
+    text = tokenizer_service.decode(tokens)
+    sentences = split_into_sentences(text)
+    offsets = sentence_offsets(sentences)
+    if trim_dir == TRIM_DIR_TOP:
+        text_end = len(text)
+        for idx in range(len(sentences) - 1, -1, -1):
+            sentence_idx = offsets[idx]
+            if (sentence_idx > 0) and (sentence_idx < len(text)) and (text[sentence_idx] == ' '):
+                sentence_idx -= 1
+            if len(tokenizer_service.encode(text[sentence_idx:])) >= limit:
+                return tokenizer_service.encode(text[text_end:])
+            text_end = max(sentence_idx - 1, 0)
+    else:
+        last_sentence_idx = 0
+        for idx in range(len(sentences)):
+            sentence_end = offsets[idx] + len(sentences[idx])
+            if (sentence_end < len(text)) and (text[sentence_end] == '\n'):
+                sentence_end += 1
+            if len(tokenizer_service.encode(text[0:sentence_end])) >= limit:
+                return tokenizer_service.encode(text[0:last_sentence_idx])
+            last_sentence_idx = sentence_end
+    return tokens
+
+WORDS = ['the', 'lantern', 'Reimu', 'shrine', 'old', 'tea', 'rain', 'gate', '42', 'youkai', 'bell', 'said', 'quietly', 'Mr.', 'e.g.', "don't", '"yes"', 'naïve', '—', 'café']
+ENDINGS = ['.', '!', '?', '...', '."', '?!']
+SEPARATORS = [' ', ' ', ' ', '\n', '\n\n', '\n\n\n', '\r\n', '\r\n\r\n', '  ', '\t']
+
+def random_text(rng):
+    parts = ['\n' * rng.randint(0, 3)]
+    for _ in range(rng.randint(1, 25)):
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        parts.append(sentence[0].upper() + sentence[1:] + rng.choice(ENDINGS))
+        parts.append(rng.choice(SEPARATORS))
+    return ''.join(parts)
+
+FIXED_TEXTS = [
+    'First line.\r\nSecond line.\r\n\r\nThird line.\r\n',
+    '\n\n\nLeading newlines. Then a sentence.\nAnd a line.',
+    'One.\n\n\n\n\nTwo after a run of blank lines.\n\n\n\nThree.',
+    ' \n \n Spaces before newlines. \n\nMore text here.',
+    'No terminal punctuation at all\nbut several lines\nof it',
+    'A sentence.  Two spaces.  Another one!  And a question?',
+    'Trailing newlines.\n\n\n',
+    '\r\n\r\nCRLF at the start. Then more.\r\n',
+]
+
+def cases():
+    rng = random.Random(1234)
+    texts = FIXED_TEXTS + [random_text(rng) for _ in range(150)]
+    for text in texts:
+        tokens = tokenizer_service.encode(text)
+        for limit in sorted(set([0, 1, 2, 5, len(tokens) // 3, len(tokens) // 2, len(tokens) - 1])):
+            if limit >= 0:
+                yield text, tokens, limit
+
+@pytest.mark.parametrize('trim_dir', [TRIM_DIR_TOP, TRIM_DIR_BOTTOM])
+def test_trim_newlines_matches_reference(trim_dir):
+    for text, tokens, limit in cases():
+        trimmed = trim_newlines(tokens, trim_dir, limit)
+        assert trimmed == reference_trim_newlines(tokens, trim_dir, limit), (text, limit)
+        assert len(trimmed) <= limit, (text, limit)
+
+@pytest.mark.parametrize('trim_dir', [TRIM_DIR_TOP, TRIM_DIR_BOTTOM])
+def test_trim_sentences_matches_reference(trim_dir):
+    for text, tokens, limit in cases():
+        trimmed = trim_sentences(tokens, trim_dir, limit)
+        expected = reference_trim_sentences(tokens, trim_dir, limit)
+        assert tokenizer_service.decode(trimmed) == tokenizer_service.decode(expected), (text, limit)
+
+def test_trim_to_dispatches_on_trim_type():
+    text = 'First sentence here. Second sentence here. Third sentence here.'
+    tokens = tokenizer_service.encode(text)
+    limit = len(tokens) - 2
+    entry = ContextEntry(text=text, suffix='', trim_direction=TRIM_DIR_BOTTOM, trim_type=TRIM_TYPE_TOKEN)
+    assert entry.trim_to(tokens, limit) == tokens[:limit]
+    entry.trim_type = TRIM_TYPE_SENTENCE
+    assert entry.trim_to(tokens, limit) == trim_sentences(tokens, TRIM_DIR_BOTTOM, limit)
+    entry.trim_type = TRIM_TYPE_NEWLINE
+    assert entry.trim_to(tokens, limit) == trim_newlines(tokens, TRIM_DIR_BOTTOM, limit)
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import uuid
+import pytest
+
+pytest.importorskip('asyncpg')
+
+# runs against the database at TEST_DATABASE_URI, see conftest.py. the tables are
+# created when missing and every test works on a story of its own
+if 'TEST_DATABASE_URI' not in os.environ:
+    pytest.skip('TEST_DATABASE_URI is not set', allow_module_level=True)
+
+from src.db.base_class import Base
+from src.db.database import engine
+from src.stories.db import story_delete, story_get, story_get_metadata, story_update_metadata, story_upsert
+
+def run(test):
+    async def main():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        story_uuid = str(uuid.uuid4())
+        await story_upsert(uuid=story_uuid, owner_id=0, content_metadata={'name': 'test', 'memory': ''}, content='[]', activation=None)
+        try:
+            await test(story_uuid)
+        finally:
+            await story_delete(story_uuid)
+            await engine.dispose()
+    asyncio.run(main())
+
+def test_update_metadata_reads_back_the_values():
+    async def test(story_uuid):
+        fields = {'authorsNote': '[ A/N: dark ]', 'memory': 'Sakuya is a maid.', 'tags': ['a', 'b'], 'turns': 3}
+        returned = await story_update_metadata(story_uuid, fields)
+        stored = (await story_get(story_uuid)).content_metadata
+        assert returned == stored == {'name': 'test', **fields}
+    run(test)
+
+def test_update_metadata_of_a_missing_story():
+    async def test(story_uuid):
+        assert await story_update_metadata(str(uuid.uuid4()), {'memory': 'x'}) is None
+    run(test)
+
+def test_get_metadata_reads_back_the_updated_values():
+    async def test(story_uuid):
+        await story_update_metadata(story_uuid, {'authorsNote': '[ A/N: dark ]'})
+        assert await story_get_metadata(story_uuid) == {'name': 'test', 'memory': '', 'authorsNote': '[ A/N: dark ]'}
+        assert await story_get_metadata(str(uuid.uuid4())) is None
+    run(test)
@@ -0,0 +1,75 @@
+import json
+import pytest
+
+pytest.importorskip('transformers')
+
+from src.stories.context import Lorebook
+from src.stories.story import Story, STORY_TEXTTYPE_AI, STORY_TEXTTYPE_USER
+
+FILLER = 'The rain kept falling over the misty lake all through the night.\n'
+
+@pytest.fixture
+def lorebook(tmp_path):
+    path = tmp_path / 'test.lorebook'
+    path.write_text(json.dumps({'lorebookVersion': 4, 'entries': [{
+        'text': 'Sakuya Izayoi is the head maid of the Scarlet Devil Mansion.',
+        'contextConfig': {
+            'prefix': '', 'suffix': '\n', 'tokenBudget': 2048, 'reservedTokens': 0, 'budgetPriority': 400,
+            'trimDirection': 'trimBottom', 'insertionType': 'newline', 'maximumTrimType': 'sentence', 'insertionPosition': -1
+        },
+        'id': 'sakuya',
+        'keys': ['Sakuya'],
+        'searchRange': 100,
+        'enabled': True,
+        'forceActivation': False,
+        'nonStoryActivatable': False
+    }]}))
+    return Lorebook(str(path))
+
+def active_ids(story, lorebook):
+    return [entry.id for entry in story.activate(lorebook)]
+
+# a story whose mention of Sakuya left the search range, every turn activated like on generate
+def sticky_story(lorebook, sticky_turns=5):
+    story = Story(owner_id=0)
+    story.content.activation.sticky_turns = sticky_turns
+    story.action('Sakuya walks in.\n', STORY_TEXTTYPE_USER)
+    assert active_ids(story, lorebook) == ['sakuya']
+    for _ in range(2):
+        story.action(FILLER, STORY_TEXTTYPE_AI)
+        assert active_ids(story, lorebook) == ['sakuya']
+    return story
+
+def test_undo_keeps_sticky_entries(lorebook):
+    story = sticky_story(lorebook)
+    story.action(FILLER, STORY_TEXTTYPE_USER)
+    story.undo()
+    assert active_ids(story, lorebook) == ['sakuya']
+    # a retry: the generated action is undone and generated again
+    story.action(FILLER, STORY_TEXTTYPE_AI)
+    assert active_ids(story, lorebook) == ['sakuya']
+    story.undo()
+    story.action(FILLER, STORY_TEXTTYPE_AI)
+    assert active_ids(story, lorebook) == ['sakuya']
+
+def test_undo_matches_the_activation_without_the_undone_actions(lorebook):
+    story = sticky_story(lorebook, sticky_turns=3)
+    other = sticky_story(lorebook, sticky_turns=3)
+    story.action('Sakuya throws her knives.\n', STORY_TEXTTYPE_USER)
+    assert active_ids(story, lorebook) == ['sakuya']
+    story.undo()
+    for _ in range(3):
+        story.action(FILLER, STORY_TEXTTYPE_AI)
+        other.action(FILLER, STORY_TEXTTYPE_AI)
+        assert active_ids(story, lorebook) == active_ids(other, lorebook)
+    # sticky_turns ran out on both
+    assert active_ids(story, lorebook) == []
+
+def test_undo_before_the_first_activation_searches_again(lorebook):
+    story = sticky_story(lorebook)
+    for _ in range(3):
+        story.undo()
+    assert story.content.activation.history == []
+    assert active_ids(story, lorebook) == []
+    story.action('Sakuya bows.\n', STORY_TEXTTYPE_USER)
+    assert active_ids(story, lorebook) == ['sakuya']